@@ -0,0 +1,452 @@
+# Assignment and page containers for problem position detection
+
+# Imports
+
+import asyncio
+import numpy as np
+import os
+from PIL import Image
+from typing import Any, Dict, List, Tuple
+
+from instrumentation import labels, span
+from page_manifest import FULL_HEIGHT, MANIFEST_FILE, PLAIN_VARIANT, SHARPENED_VARIANT, PageManifest, parse_page_file_name
+from payload import ImagePayload, encode_for_budget
+from response_cache import ResponseCache
+from upper_bounds import (
+    SUPPORTED_IMAGE_FORMATS,
+    get_detected_solution_upper_bounds,
+    get_numbered_solution_upper_bounds,
+    get_solution_numbers,
+    validate_numbered_solution_upper_bounds,
+)
+
+
+IMAGE_HEIGHT = str(768) # Image height, used for filtering images in the input directory - images have height in the name
+RESOLUTION_LADDER = ["640", "768", FULL_HEIGHT] # Image heights tried in order by find_problem_positions_adaptive
+
+
+########
+# Prompts
+def upper_bounds_system_prompt() -> str:
+    system_prompt = f"""
+    Return the y-axis positions for the upper bound of the problems in the image corresponding to the provided problem numbers, normalized by 1000.
+    """
+    return system_prompt
+
+
+def upper_bounds_user_prompt(solution_numbers: List[str]) -> str:
+
+    user_prompt=f"""
+    Detect the y-coordinate of the upper boundary problems in the provided image, including the problem statement.
+
+    TASK DEFINITION:
+    - For each problem identifier provided in the input list, identify the upper boundary of the entire problem, including the problem statement.
+    - Return the y-coordinate value (in pixels from the top of the image) for this upper boundary.
+    - The y-coordinate represents the vertical position where the identifier to a problem begins.
+
+    PROBLEM NUMBERING CONVENTIONS:
+    - Problem identifiers are provided as strings in the solution_numbers list.
+    - These identifiers represent main problems (e.g., "1", "2.", "3)", "4.5")
+
+    OUTPUT FORMAT:
+    - Use -1 for any problem whose boundary cannot be confidently determined, or if the problem is not present in the image.
+
+    HANDLING EDGE CASES:
+    - If problem boundaries are unclear or solutions overlap, use visual cues such as whitespace, horizontal lines, or changes in formatting to determine boundaries.
+    - If multiple possible boundaries exist, choose the most visually distinct one.
+
+    The problem identifiers to detect are: {solution_numbers}
+    """
+    return user_prompt
+
+
+########
+class Assignment():
+
+    def __init__(self, assignment_name: str, input_directory: str, problem_numbers: List[str], image_height: str=IMAGE_HEIGHT, variant: str=PLAIN_VARIANT, manifest: PageManifest|None=None, max_payload_bytes: int|None=None):
+        self.assignment_name: str = assignment_name
+        self.input_directory: str = input_directory
+        self.problem_numbers: List[str] = list(problem_numbers) # Copied, combined detection appends the problem numbers it finds
+        self.pages: List[Page] = []
+
+        self.image_height = str(image_height)
+        self.variant = variant
+        self.manifest = manifest
+        self.max_payload_bytes = max_payload_bytes
+
+        self._add_pages()
+
+        print(f"Created assignment {self.assignment_name} with {len(self.pages)} pages.")
+        print(f"Problem numbers: {self.problem_numbers}")
+        print(f"Pages: {[page.page_name for page in self.pages]}")
+
+
+    def _add_pages(self) -> None:
+
+        # Look pages up in the manifest written at ingestion time, if there is one.
+        # A manifest that no longer matches the directory is refreshed from one listing first
+        if self.manifest is None and os.path.exists(os.path.join(self.input_directory, MANIFEST_FILE)):
+            self.manifest = PageManifest.for_directory(self.input_directory)
+            if not self.manifest.is_current():
+                print(f"-- Refreshing the page manifest of {self.input_directory}")
+                self.manifest.sync(sorted(os.listdir(self.input_directory)))
+
+        if self.manifest is not None:
+            page_jpgs = [record.file_name for record in self.manifest.pages(self.assignment_name, height=self.image_height, variant=self.variant)]
+        else:
+            # Get sorted list of jpgs whose parsed name matches the assignment name, image height and variant (see __init__)
+            records = [parse_page_file_name(page_jpg) for page_jpg in sorted(os.listdir(self.input_directory))]
+            page_jpgs = [record.file_name for record in records if record is not None and record.assignment_name == self.assignment_name and record.height == self.image_height and record.variant == self.variant]
+
+        # Pages are lazy, images are only read when first used
+        self.pages = []
+        for page_jpg in page_jpgs:
+            page = Page(page_name=page_jpg.split(".jpg")[0], input_directory=self.input_directory, input_file=page_jpg, max_payload_bytes=self.max_payload_bytes)
+            self.pages.append(page)
+
+
+    async def find_problem_positions(self, max_concurrency: int=1, cache: ResponseCache|None=None, skip_pages: List[int]=[]) -> None:
+        """
+        Find the problem positions on every page of the assignment.
+        Pages are sent to the LLM concurrently, with at most max_concurrency requests in flight.
+        Results are written back to each page in page order. A page whose request fails keeps
+        its exception in page.error and does not stop the other pages.
+        If the assignment has no problem numbers, each page is sent once to detect problem numbers and
+        upper bounds together. Pages whose combined result fails validation fall back to two requests,
+        get_solution_numbers then get_numbered_solution_upper_bounds. The problem numbers found are
+        then stored in problem_numbers, in order of first appearance.
+        Args:
+            max_concurrency (int, optional): Maximum number of LLM requests in flight. 1 processes pages one at a time.
+            cache (ResponseCache, optional): Cache of LLM responses. Pages already in the cache are not sent to the LLM.
+            skip_pages (List[int], optional): Indices of pages known to have no problem start (see profiles.pages_without_candidates). They are not sent to the LLM.
+        """
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        await self._find_problem_positions(semaphore=semaphore, cache=cache, skip_pages=skip_pages)
+
+
+    async def _find_problem_positions(self, semaphore: asyncio.Semaphore, cache: ResponseCache|None=None, skip_pages: List[int]=[]) -> None:
+
+        if len(self.problem_numbers) == 0:
+            request_page_upper_bounds = self._request_page_detected_upper_bounds
+        else:
+            request_page_upper_bounds = self._request_page_upper_bounds
+
+        async def request(page: Page) -> Tuple[Any, List[str]]:
+            # Page latency includes waiting for the semaphore
+            with span("page", page=page.page_name):
+                return await request_page_upper_bounds(page=page, semaphore=semaphore, cache=cache)
+
+        pages = [page for k1, page in enumerate(self.pages) if k1 not in skip_pages]
+        with labels(assignment=self.assignment_name):
+            results = await asyncio.gather(*[request(page) for page in pages], return_exceptions=True)
+
+        for k1 in skip_pages:
+            if k1 < len(self.pages):
+                self.pages[k1].detection_mode = "skipped"
+
+        # Write results back in page order
+        for page, result in zip(pages, results):
+            if isinstance(result, BaseException):
+                page.error = result
+                print(f"-- Failed to find problem positions on page {page.page_name}: {result!r}")
+                continue
+            response, solution_numbers = result
+            try:
+                self._apply_response(page=page, response=response, solution_numbers=solution_numbers)
+            except Exception as error:
+                page.error = error
+                print(f"-- Failed to read problem positions on page {page.page_name}: {error!r}")
+
+        if len(self.problem_numbers) == 0:
+            for page in self.pages:
+                for problem_number in page.found_problems.keys():
+                    if problem_number not in self.problem_numbers:
+                        self.problem_numbers.append(problem_number)
+
+
+    async def find_problem_positions_adaptive(self, ladder: List[str]=RESOLUTION_LADDER, max_concurrency: int=1, cache: ResponseCache|None=None) -> Dict[str, int]:
+        """
+        Find the problem positions, sending each page at the smallest height first.
+        A page is sent at the next height in the ladder only when the result is unusable: bounds out of
+        range, duplicated or missing identifiers, bounds not increasing in problem order, or a -1 for a
+        problem between two problems found on the page. A -1 before the first or after the last problem
+        found is the normal answer for problems on other pages and does not escalate.
+        Bounds already found at a smaller height are kept, and only the remaining problems are requested
+        at the next height. Normalized bounds do not depend on the height, so they combine directly.
+        Each page records its attempts in page.escalations.
+        Args:
+            ladder (List[str], optional): Image heights to try, smallest first. Heights without a file for a page are skipped.
+            max_concurrency (int, optional): Maximum number of LLM requests in flight.
+            cache (ResponseCache, optional): Cache of LLM responses.
+        Returns:
+            Dict[str, int]: Number of pages resolved at each height, and "unresolved" for pages that never passed.
+        """
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        resolved_heights = await asyncio.gather(*[self._find_page_problem_positions_adaptive(page=page, ladder=ladder, semaphore=semaphore, cache=cache) for page in self.pages], return_exceptions=True)
+
+        summary = {height: 0 for height in ladder}
+        summary["unresolved"] = 0
+        for page, resolved_height in zip(self.pages, resolved_heights):
+            if isinstance(resolved_height, BaseException):
+                page.error = resolved_height
+                print(f"-- Failed to find problem positions on page {page.page_name}: {resolved_height!r}")
+                resolved_height = None
+            summary["unresolved" if resolved_height is None else resolved_height] += 1
+        return summary
+
+
+    async def _find_page_problem_positions_adaptive(self, page: "Page", ladder: List[str], semaphore: asyncio.Semaphore, cache: ResponseCache|None=None) -> str|None:
+
+        page.escalations = []
+        found: Dict[str, int] = {}
+        resolved_height = None
+
+        for height in ladder:
+            ladder_page = self._page_at_height(page=page, height=height)
+            if ladder_page is None:
+                continue
+
+            request_numbers = [problem_number for problem_number in self.problem_numbers if problem_number not in found]
+            async with semaphore:
+                response = await get_numbered_solution_upper_bounds(
+                        image_bytes=await ladder_page.load_payload(),
+                        system_prompt=upper_bounds_system_prompt(),
+                        user_prompt=upper_bounds_user_prompt(request_numbers),
+                        solution_numbers=request_numbers,
+                        cache=cache,
+                    )
+            page.response = response
+            upper_bounds = response.structured_response.upper_bounds
+
+            problems = validate_numbered_solution_upper_bounds(upper_bounds, solution_numbers=request_numbers)
+            if len(problems) == 0:
+                combined = dict(found)
+                combined.update({problem_number: upper_bound.upper_bound for problem_number, upper_bound in zip(request_numbers, upper_bounds) if upper_bound.upper_bound != -1})
+                problems = self._ladder_problems(combined)
+                # Keep what was found unless the combined bounds are out of order
+                if not any("not increasing" in problem for problem in problems):
+                    found = combined
+
+            page.escalations.append({"height": height, "requested": len(request_numbers), "problems": problems})
+            if len(problems) == 0:
+                resolved_height = height
+                break
+
+        page.error = None
+        page.detection_mode = "adaptive"
+        page.found_problems_normalized = {problem_number: found[problem_number] for problem_number in self.problem_numbers if problem_number in found}
+        page.found_problems = {problem_number: int(np.floor(page.image_size[1] / 1000 * upper_bound)) for problem_number, upper_bound in page.found_problems_normalized.items()}
+        return resolved_height
+
+
+    def _ladder_problems(self, found: Dict[str, int]) -> List[str]:
+
+        problems = []
+        found_numbers = [problem_number for problem_number in self.problem_numbers if problem_number in found]
+        bounds = [found[problem_number] for problem_number in found_numbers]
+        if any(bounds[k1] > bounds[k1 + 1] for k1 in range(len(bounds) - 1)):
+            problems.append("upper bounds not increasing in problem order")
+        if len(found_numbers) > 0:
+            first = self.problem_numbers.index(found_numbers[0])
+            last = self.problem_numbers.index(found_numbers[-1])
+            holes = [problem_number for problem_number in self.problem_numbers[first:last + 1] if problem_number not in found]
+            if len(holes) > 0:
+                problems.append(f"missing {holes} between found problems")
+        return problems
+
+
+    def _page_at_height(self, page: "Page", height: str) -> "Page|None":
+
+        if str(height) == self.image_height:
+            return page
+        record = parse_page_file_name(page.input_file)
+        if record is None:
+            return None
+        suffix = "_sharpened" if record.variant == SHARPENED_VARIANT else ""
+        input_file = f"{record.assignment_name}_{record.page_index:02d}_{height}{suffix}.jpg"
+        if not os.path.exists(os.path.join(self.input_directory, input_file)):
+            return None
+        return Page(page_name=input_file.split(".jpg")[0], input_directory=self.input_directory, input_file=input_file, max_payload_bytes=self.max_payload_bytes)
+
+
+    async def find_problem_positions_with_detector(self, detector: Any) -> None:
+        """
+        Find the problem positions with a detector backend instead of the default LLM request.
+        A page that fails keeps its exception in page.error and does not stop the other pages.
+        Args:
+            detector (DetectorBackend): For example detectors.LLMDetector or detectors.YOLODetector.
+        """
+        try:
+            structured_responses = await detector.detect(self.pages, self.problem_numbers)
+        except Exception as error:
+            structured_responses = [error] * len(self.pages)
+
+        for page, structured_response in zip(self.pages, structured_responses):
+            try:
+                if isinstance(structured_response, BaseException):
+                    raise structured_response
+                self._apply_response(page=page, response=DetectorResponse(structured_response=structured_response), solution_numbers=self.problem_numbers)
+                page.detection_mode = type(detector).__name__
+            except Exception as error:
+                page.error = error
+                print(f"-- Failed to find problem positions on page {page.page_name}: {error!r}")
+
+
+    async def _request_page_upper_bounds(self, page: "Page", semaphore: asyncio.Semaphore, cache: ResponseCache|None=None) -> Tuple[Any, List[str]]:
+
+        async with semaphore:
+            response = await get_numbered_solution_upper_bounds(
+                    image_bytes=await page.load_payload(),
+                    system_prompt=upper_bounds_system_prompt(),
+                    user_prompt=upper_bounds_user_prompt(self.problem_numbers),
+                    solution_numbers=self.problem_numbers,
+                    cache=cache,
+                )
+        page.detection_mode = "numbered"
+        return response, self.problem_numbers
+
+
+    async def _request_page_detected_upper_bounds(self, page: "Page", semaphore: asyncio.Semaphore, cache: ResponseCache|None=None) -> Tuple[Any, List[str]]:
+
+        async with semaphore:
+            response = await get_detected_solution_upper_bounds(image_bytes=await page.load_payload(), cache=cache)
+        upper_bounds = response.structured_response.upper_bounds
+        problems = validate_numbered_solution_upper_bounds(upper_bounds, allow_missing=False)
+        if len(problems) == 0:
+            page.detection_mode = "combined"
+            return response, [upper_bound.solution_number for upper_bound in upper_bounds]
+
+        # Fall back to finding the problem numbers first, then their upper bounds
+        print(f"-- Combined detection on page {page.page_name} failed validation ({', '.join(problems)}), using two requests")
+        async with semaphore:
+            solution_numbers = (await get_solution_numbers(image_bytes=await page.load_payload(), cache=cache)).structured_response.solution_numbers
+        async with semaphore:
+            response = await get_numbered_solution_upper_bounds(
+                    image_bytes=await page.load_payload(),
+                    system_prompt=upper_bounds_system_prompt(),
+                    user_prompt=upper_bounds_user_prompt(solution_numbers),
+                    solution_numbers=solution_numbers,
+                    cache=cache,
+                )
+        page.detection_mode = "two_step"
+        return response, solution_numbers
+
+
+    def _apply_response(self, page: "Page", response: Any, solution_numbers: List[str]) -> None:
+
+        page.response = response
+        page.error = None
+        page.found_problems = {}
+        page.found_problems_normalized = {}
+        for k2 in range(0, len(solution_numbers)):
+            if response.structured_response.upper_bounds[k2].upper_bound != -1:
+                page.found_problems_normalized[solution_numbers[k2]] = response.structured_response.upper_bounds[k2].upper_bound
+                page.found_problems[solution_numbers[k2]] = int(np.floor(page.image_size[1] / 1000 * response.structured_response.upper_bounds[k2].upper_bound))
+
+
+class DetectorResponse():
+    """Result of a detector backend, shaped like an llm_structured response."""
+
+    def __init__(self, structured_response: Any):
+        self.structured_response = structured_response
+
+
+class Page():
+    """
+    One page image of an assignment.
+    Nothing is read from disk until it is used: image_size reads the JPEG header,
+    payload reads the file bytes, and pil_image decodes the pixels.
+    """
+
+    def __init__(self, page_name: str, input_directory: str, input_file: str, max_payload_bytes: int|None=None):
+        self.page_name = page_name
+        self.input_directory = input_directory
+        self.input_file = input_file
+        self.path_to_input_file = str(os.path.join(self.input_directory, self.input_file))
+        self.max_payload_bytes = max_payload_bytes
+        self.response = None
+        self.error = None
+        self.detection_mode = None
+        self.escalations = []
+        self.found_problems = {}
+        self.found_problems_normalized = {}
+        self._pil_image: Image.Image|None = None
+        self._payload: ImagePayload|None = None
+        self._image_size: Tuple[int, int]|None = None
+
+    @property
+    def pil_image(self) -> Image.Image:
+        if self._pil_image is None:
+            with span("decode") as stage, Image.open(self.path_to_input_file) as image:
+                image.load()
+                self._pil_image = image
+                stage.set(width=image.width, height=image.height)
+            self._image_size = self._pil_image.size
+        return self._pil_image
+
+    @pil_image.setter
+    def pil_image(self, pil_image: Image.Image) -> None:
+        self._pil_image = pil_image
+        self._image_size = pil_image.size
+
+    @property
+    def payload(self) -> ImagePayload:
+        # Original file bytes, sent to the LLM without re-encoding unless they are over max_payload_bytes
+        if self._payload is None:
+            self._payload = ImagePayload.from_file(file_path = self.path_to_input_file)
+            if self.max_payload_bytes is not None and len(self._payload) > self.max_payload_bytes:
+                self._payload = encode_for_budget(self.pil_image, max_bytes=self.max_payload_bytes, formats=SUPPORTED_IMAGE_FORMATS, source_bytes=len(self._payload))
+        return self._payload
+
+    async def load_payload(self) -> ImagePayload:
+        """
+        The payload, read and, if over max_payload_bytes, re-encoded in a worker thread so other requests keep running.
+        """
+        if self._payload is not None:
+            return self._payload
+        return await asyncio.to_thread(lambda: self.payload)
+
+    @property
+    def image_bytes(self) -> bytes:
+        return self.payload.image_bytes
+
+    @property
+    def image_size(self) -> Tuple[int, int]:
+        if self._image_size is None:
+            # Opening an image only reads its header
+            with Image.open(self.path_to_input_file) as image:
+                self._image_size = image.size
+        return self._image_size
+
+    @property
+    def is_decoded(self) -> bool:
+        return self._pil_image is not None
+
+    def unload(self) -> None:
+        """
+        Release the decoded pixels and file bytes. They are read again on next use.
+        """
+        self._pil_image = None
+        self._payload = None
+
+
+########
+async def find_problem_positions_for_assignments(assignments: List[Assignment], max_concurrency: int=8, cache: ResponseCache|None=None) -> Dict[str, List[str]]:
+    """
+    Find the problem positions for many assignments, sharing one concurrency budget.
+    Args:
+        assignments (List[Assignment]): The assignments to process.
+        max_concurrency (int, optional): Maximum number of LLM requests in flight across all assignments.
+        cache (ResponseCache, optional): Cache of LLM responses shared by all assignments.
+    Returns:
+        Dict[str, List[str]]: Names of the pages that failed, keyed by assignment name.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    await asyncio.gather(*[assignment._find_problem_positions(semaphore=semaphore, cache=cache) for assignment in assignments])
+
+    failed_pages = {}
+    for assignment in assignments:
+        failed = [page.page_name for page in assignment.pages if page.error is not None]
+        if len(failed) > 0:
+            failed_pages[assignment.assignment_name] = failed
+    return failed_pages
@@ -0,0 +1,82 @@
+# Cold-import time of the library, checked against a budget
+#
+# Usage:
+#   python benchmarks/bench_import.py --budget 1.0
+#   python benchmarks/bench_import.py --importtime   # also list the slowest imports
+#
+# Each measurement imports the modules in a fresh interpreter. Exits with 1 if the median import time
+# is over the budget, or if a notebook-only or heavy dependency (Tk, IPython, pdf2image, ...) was imported.
+
+# Imports
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ["util", "upper_bounds", "assignment", "ingest"]
+
+# Modules that must only be imported when the feature that needs them is used
+LAZY_MODULES = ["turtle", "tkinter", "IPython", "pdf2image", "ultralytics", "pandas", "matplotlib"]
+
+
+def measure(modules: List[str]) -> Dict:
+
+    code = f"""
+import json, sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": sorted(sys.modules.keys())}}))
+"""
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPOSITORY_DIRECTORY, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(modules: List[str], count: int=15) -> List[Tuple[int, str]]:
+    """
+    Cumulative microseconds of the slowest imports, from python -X importtime.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"], cwd=REPOSITORY_DIRECTORY, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_time, cumulative, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check the cold-import time of the library against a budget.")
+    parser.add_argument("--modules", nargs="*", default=MODULES)
+    parser.add_argument("--budget", type=float, default=1.0, help="Maximum median import time, in seconds")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--importtime", action="store_true", help="List the slowest imports")
+    args = parser.parse_args()
+
+    measurements = [measure(args.modules) for k1 in range(args.repeat)]
+    median_seconds = statistics.median(measurement["seconds"] for measurement in measurements)
+    loaded = set(measurements[-1]["modules"])
+    eager = [name for name in LAZY_MODULES if name in loaded]
+
+    print(f"Import of {', '.join(args.modules)}: median {median_seconds:.3f} s over {args.repeat} runs, budget {args.budget:.3f} s")
+    if args.importtime:
+        for cumulative, name in slowest_imports(args.modules):
+            print(f"{cumulative / 1e6:8.3f} s  {name}")
+
+    failed = False
+    if median_seconds > args.budget:
+        print(f"-- Over budget by {median_seconds - args.budget:.3f} s")
+        failed = True
+    if len(eager) > 0:
+        print(f"-- Imported eagerly: {', '.join(eager)}")
+        failed = True
+    sys.exit(1 if failed else 0)
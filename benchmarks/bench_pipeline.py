@@ -0,0 +1,163 @@
+# End-to-end benchmark over the pdf/ corpus: ingestion, then find_problem_positions with replayed LLM responses
+#
+# Usage:
+#   python benchmarks/bench_pipeline.py --record            # once, with provider credentials, to write fixtures
+#   python benchmarks/bench_pipeline.py                     # offline, compared against benchmarks/baseline.json
+#   python benchmarks/bench_pipeline.py --update-baseline   # accept the current numbers as the baseline
+#
+# Reports ingestion and detection throughput, p50/p95 latency per page and per request, and peak memory.
+# The baseline is only written with --update-baseline; otherwise a regression beyond --tolerance exits with 1.
+
+# Imports
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import instrumentation
+from assignment import Assignment, find_problem_positions_for_assignments
+from ingest import ingest, load_manifest
+from replay import DEFAULT_FIXTURE_DIRECTORY, RECORD, REPLAY, ReplayLLM, install_replay, uninstall_replay
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Whether a larger value is better, for each metric compared against the baseline
+HIGHER_IS_BETTER = {
+    "ingest_pages_per_second": True,
+    "detect_pages_per_second": True,
+    "page_latency_p50": False,
+    "page_latency_p95": False,
+    "request_latency_p50": False,
+    "request_latency_p95": False,
+    "peak_rss_mb": False,
+    "ingest_peak_rss_mb": False,
+}
+
+
+def _percentile(values: List[float], quantile: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(quantile * len(values)))]
+
+
+def _peak_rss_mb(who: int) -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def run(args: argparse.Namespace, output_directory: str) -> Dict[str, float]:
+
+    manifest = load_manifest(args.manifest)
+    if len(args.assignments) > 0:
+        manifest = {assignment_name: pages for assignment_name, pages in manifest.items() if assignment_name in args.assignments}
+
+    # Ingestion, in worker processes
+    report = ingest(manifest, input_directory=args.input_directory, output_directory=output_directory, heights=[int(args.image_height)], workers=args.workers)
+    page_count = sum(1 for outputs in report.outputs.values() for file_name in outputs if file_name.endswith(f"_{args.image_height}.jpg"))
+
+    # Detection, against fixtures
+    replay = ReplayLLM(fixture_directory=args.fixtures, mode=RECORD if args.record else REPLAY, latency=args.latency, latency_scale=args.latency_scale)
+    previous = install_replay(replay)
+    instrumentation.enable(run_id="bench_pipeline")
+    try:
+        assignments = [Assignment(assignment_name=assignment_name, input_directory=output_directory, problem_numbers=[], image_height=args.image_height) for assignment_name in sorted(report.outputs.keys())]
+        start = time.perf_counter()
+        failed_pages = asyncio.run(find_problem_positions_for_assignments(assignments, max_concurrency=args.max_concurrency))
+        detect_seconds = time.perf_counter() - start
+    finally:
+        uninstall_replay(previous)
+
+    records = instrumentation.records()
+    instrumentation.disable()
+    page_latencies = [record["seconds"] for record in records if record["stage"] == "page"]
+    request_latencies = [record["seconds"] for record in records if record["stage"] == "llm" and "error" not in record]
+
+    print(f"Replay: {replay.stats()}")
+    if len(failed_pages) > 0:
+        print(f"Failed pages: {failed_pages}")
+
+    return {
+        "pages": page_count,
+        "failed_pages": sum(len(pages) for pages in failed_pages.values()),
+        "ingest_seconds": report.seconds,
+        "ingest_pages_per_second": page_count / report.seconds if report.seconds > 0 else 0.0,
+        "detect_seconds": detect_seconds,
+        "detect_pages_per_second": len(page_latencies) / detect_seconds if detect_seconds > 0 else 0.0,
+        "page_latency_p50": _percentile(page_latencies, 0.50),
+        "page_latency_p95": _percentile(page_latencies, 0.95),
+        "request_latency_p50": _percentile(request_latencies, 0.50),
+        "request_latency_p95": _percentile(request_latencies, 0.95),
+        "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+        "ingest_peak_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def compare(metrics: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    """
+    Describe the metrics that regressed by more than tolerance (a fraction) against the baseline.
+    """
+    regressions = []
+    for name, higher_is_better in HIGHER_IS_BETTER.items():
+        if name not in baseline or baseline[name] == 0:
+            continue
+        change = (metrics[name] - baseline[name]) / baseline[name]
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append(f"{name}: {metrics[name]:.3f} vs baseline {baseline[name]:.3f} ({change:+.0%})")
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark ingestion and problem detection over the PDF corpus with replayed LLM responses.")
+    parser.add_argument("--manifest", default="pdf_manifest.json")
+    parser.add_argument("--input-directory", default="pdf")
+    parser.add_argument("--output-directory", default="", help="Where to write page images, a temporary directory if omitted")
+    parser.add_argument("--assignments", nargs="*", default=[], help="Only these assignments, every assignment in the manifest if omitted")
+    parser.add_argument("--image-height", default="768")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURE_DIRECTORY)
+    parser.add_argument("--record", action="store_true", help="Send requests to the provider and write fixtures")
+    parser.add_argument("--latency", type=float, default=None, help="Simulated seconds per request, the recorded latency if omitted")
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    if args.output_directory != "":
+        os.makedirs(args.output_directory, exist_ok=True)
+        metrics = run(args, args.output_directory)
+    else:
+        with tempfile.TemporaryDirectory() as output_directory:
+            metrics = run(args, output_directory)
+
+    print(json.dumps(metrics, indent=1))
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(metrics, f, indent=1)
+            f.write("\n")
+        print(f"Wrote baseline {args.baseline}")
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --update-baseline to create it")
+        sys.exit(0)
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = compare(metrics, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"-- Regression {regression}")
+    sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,53 @@
+# Throughput of the projection profile engine on synthetic pages
+#
+# Usage:
+#   python benchmarks/bench_profiles.py --pages 500 --height 768
+
+# Imports
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from profiles import find_candidate_starts, find_whitespace_gaps, row_ink_profiles
+
+
+def synthetic_stack(page_count: int, height: int, width: int, seed: int=0) -> np.ndarray:
+    """
+    White pages with a few blocks of text lines, each block starting with a label in the left margin.
+    """
+    generator = np.random.default_rng(seed)
+    stack = np.full((page_count, height, width), 255, dtype=np.uint8)
+    line_height = max(2, height // 80)
+    for k1 in range(page_count):
+        for top in np.sort(generator.choice(np.arange(height // 20, height - height // 5, height // 10), size=3, replace=False)):
+            stack[k1, top:top + 2 * line_height, width // 40:width // 10] = 0
+            for line in range(4):
+                y = top + line * (line_height + 2)
+                stack[k1, y:y + line_height, width // 5:width - width // 10] = generator.integers(0, 255, size=(line_height, width - width // 10 - width // 5), dtype=np.uint8)
+    return stack
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure pages per second of the projection profile engine.")
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--width", type=int, default=594)
+    args = parser.parse_args()
+
+    stack = synthetic_stack(args.pages, args.height, args.width)
+
+    start = time.perf_counter()
+    profiles = row_ink_profiles(stack)
+    gaps = find_whitespace_gaps(profiles)
+    candidates = find_candidate_starts(stack)
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.pages} pages of {args.width}x{args.height} in {elapsed:.3f} s: {args.pages / elapsed:.0f} pages/s")
+    print(f"Mean candidates per page: {np.mean([len(page_candidates) for page_candidates in candidates]):.2f}")
@@ -0,0 +1,103 @@
+# Benchmark page-selective, streaming rasterization against eager rasterization on the pdf/ corpus
+#
+# Usage:
+#   python benchmarks/bench_rasterize.py --input-directory pdf --pages 0 1 --stack
+#
+# Each run happens in a fresh process so peak RSS is measured per run.
+
+# Imports
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+########
+# Previous implementation of convert_pdf_to_pil_image, kept as the baseline
+def convert_pdf_to_pil_image_eager(input_directory: str, input_file: str, pages: List[int]=[], stack: bool=False, output_directory: str="", dpi: int=150, quality: int=80, suffix: str="") -> None:
+
+    from pdf2image import convert_from_path
+    from PIL import Image
+
+    images = convert_from_path(os.path.join(f"{input_directory}/", f"{input_file}.pdf"), dpi=dpi)
+    if len(pages) >= 1:
+        images = [images[k1] for k1 in pages if k1 < len(images)]
+    images = [image.convert("L") for image in images]
+
+    if stack:
+        total_height = sum(image.height for image in images)
+        max_width = max(image.width for image in images)
+        combined_image = Image.new("RGB", (max_width, total_height))
+        combined_image = combined_image.convert("L")
+        y_offset = 0
+        for image in images:
+            combined_image.paste(image, (0, y_offset))
+            y_offset += image.height
+        combined_image.save(os.path.join(f"{output_directory}/", f"{input_file}_combined{suffix}.jpg"), "JPEG", quality=quality, optimize=True)
+    else:
+        for k1, image in enumerate(images):
+            image.save(os.path.join(f"{output_directory}/", f"{input_file}_{k1:02d}{suffix}.jpg"), "JPEG", quality=quality, optimize=True)
+
+
+def _run(implementation: str, input_directory: str, input_file: str, pages: List[int], stack: bool, dpi: int, queue: multiprocessing.Queue) -> None:
+
+    from util import convert_pdf_to_pil_image
+
+    with tempfile.TemporaryDirectory() as output_directory:
+        start = time.perf_counter()
+        if implementation == "eager":
+            convert_pdf_to_pil_image_eager(input_directory, input_file, pages=pages, stack=stack, output_directory=output_directory, dpi=dpi)
+        else:
+            convert_pdf_to_pil_image(input_directory, input_file, pages=pages, stack=stack, output_directory=output_directory, dpi=dpi)
+        elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    max_rss_mb = max_rss / 1024 / 1024 if sys.platform == "darwin" else max_rss / 1024
+    queue.put({"seconds": elapsed, "max_rss_mb": max_rss_mb})
+
+
+def benchmark(input_directory: str, input_file: str, pages: List[int], stack: bool, dpi: int) -> Dict[str, Dict[str, float]]:
+    """
+    Run both implementations on one PDF, each in its own process.
+    Returns:
+        Dict[str, Dict[str, float]]: Seconds and peak RSS (MB), keyed by implementation.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for implementation in ("eager", "streaming"):
+        queue = context.Queue()
+        process = context.Process(target=_run, args=(implementation, input_directory, input_file, pages, stack, dpi, queue))
+        process.start()
+        results[implementation] = queue.get()
+        process.join()
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--input-directory", default="pdf")
+    parser.add_argument("--pages", type=int, nargs="*", default=[], help="Zero-based pages to rasterize, all pages if omitted")
+    parser.add_argument("--stack", action="store_true", help="Write one stacked JPEG instead of one JPEG per page")
+    parser.add_argument("--dpi", type=int, default=150)
+    args = parser.parse_args()
+
+    pdfs = sorted(pdf.split(".pdf")[0] for pdf in os.listdir(args.input_directory) if pdf.endswith(".pdf"))
+
+    print(f"{'pdf':<20} {'eager s':>9} {'stream s':>9} {'eager MB':>9} {'stream MB':>10}")
+    totals = {"eager": [0.0, 0.0], "streaming": [0.0, 0.0]}
+    for pdf in pdfs:
+        results = benchmark(args.input_directory, pdf, pages=args.pages, stack=args.stack, dpi=args.dpi)
+        for implementation, result in results.items():
+            totals[implementation][0] += result["seconds"]
+            totals[implementation][1] = max(totals[implementation][1], result["max_rss_mb"])
+        print(f"{pdf:<20} {results['eager']['seconds']:>9.2f} {results['streaming']['seconds']:>9.2f} {results['eager']['max_rss_mb']:>9.1f} {results['streaming']['max_rss_mb']:>10.1f}")
+    print(f"{'total / peak':<20} {totals['eager'][0]:>9.2f} {totals['streaming'][0]:>9.2f} {totals['eager'][1]:>9.1f} {totals['streaming'][1]:>10.1f}")
@@ -0,0 +1,123 @@
+# Offline accuracy check of montage batching against per-page requests
+#
+# Usage:
+#   python benchmarks/montage_accuracy.py --pages 12 --max-pages 4
+#
+# Synthetic pages carry one black label block per problem. A fake llm_structured finds the blocks
+# in whatever image it is sent, so per-page and batched runs answer from the same fake responses.
+# Problem k is drawn (k + 1) * 5% of the page width wide, which lets the fake tell problems apart.
+
+# Imports
+
+import argparse
+import ast
+import asyncio
+import base64
+import io
+import os
+import random
+import sys
+import tempfile
+from typing import Dict, List
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from assignment import Assignment
+from fake_llm import FakeLLM, install_fake_llm
+from montage import find_problem_positions_batched
+from upper_bounds import NumberedSolutionUpperBound
+
+
+LABEL_WIDTH_STEP = 0.05
+
+
+def write_synthetic_pages(directory: str, assignment_name: str, page_count: int, problem_count: int, seed: int=0) -> Dict[str, Dict[str, int]]:
+    """
+    Write pages with label blocks at random heights.
+    Returns:
+        Dict[str, Dict[str, int]]: Pixel position of each problem, keyed by page name.
+    """
+    generator = random.Random(seed)
+    truth = {}
+    problem = 0
+    for k1 in range(page_count):
+        image = Image.new("L", (1275, 1650), 255)
+        draw = ImageDraw.Draw(image)
+        page_name = f"{assignment_name}_{k1:02d}_original"
+        truth[page_name] = {}
+        for y in sorted(generator.sample(range(50, 1550, 60), k=generator.randint(0, 2))):
+            if problem >= problem_count:
+                break
+            width = int((problem + 1) * LABEL_WIDTH_STEP * image.width)
+            draw.rectangle((0, y, width, y + 30), fill=0)
+            truth[page_name][str(problem + 1)] = y
+            problem += 1
+        image.save(os.path.join(directory, f"{page_name}.jpg"), "JPEG", quality=95)
+    return truth
+
+
+def detect_label_blocks(messages, response_model):
+    """Fake structured response: the top of each label block, normalized by 1000."""
+    image = Image.open(io.BytesIO(base64.b64decode(messages[2].parts[0].content))).convert("L")
+    pixels = np.asarray(image) < 128
+    solution_numbers = ast.literal_eval(messages[1].parts[0].content.split("The problem identifiers to detect are:")[1].strip())
+
+    upper_bounds = {}
+    dark_rows = pixels.sum(axis=1) > 0
+    starts = np.flatnonzero(dark_rows & ~np.concatenate(([False], dark_rows[:-1])))
+    for start in starts:
+        # Width of the block on the first full row, as a fraction of the page width
+        row = pixels[min(start + 5, pixels.shape[0] - 1)]
+        widths = np.flatnonzero(row)
+        problem = int(round((widths.max() + 1) / image.width / LABEL_WIDTH_STEP)) if len(widths) > 0 else 0
+        upper_bounds[str(problem)] = int(start / image.height * 1000)
+
+    return response_model(upper_bounds=[NumberedSolutionUpperBound(solution_number=solution_number, upper_bound=upper_bounds.get(solution_number, -1)) for solution_number in solution_numbers])
+
+
+async def compare(page_count: int, problem_count: int, max_pages: int, page_height: int) -> Dict[str, float]:
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_synthetic_pages(directory, "SYNTHETIC_HW_01", page_count, problem_count)
+        problem_numbers = [str(k1 + 1) for k1 in range(problem_count)]
+
+        fake = FakeLLM(handler=detect_label_blocks)
+        install_fake_llm(fake)
+
+        per_page = Assignment("SYNTHETIC_HW_01", directory, problem_numbers, image_height="original")
+        await per_page.find_problem_positions(max_concurrency=8)
+        per_page_requests = fake.calls
+
+        batched = Assignment("SYNTHETIC_HW_01", directory, problem_numbers, image_height="original")
+        batched_requests = await find_problem_positions_batched(batched, max_pages=max_pages, page_height=page_height, max_concurrency=8)
+
+        mismatches = 0
+        errors = []
+        for page, batched_page in zip(per_page.pages, batched.pages):
+            if page.found_problems.keys() != batched_page.found_problems.keys():
+                mismatches += 1
+            for problem_number in page.found_problems.keys() & batched_page.found_problems.keys():
+                errors.append(abs(page.found_problems[problem_number] - batched_page.found_problems[problem_number]))
+
+    return {
+        "per_page_requests": per_page_requests,
+        "batched_requests": batched_requests,
+        "pages_with_different_problems": mismatches,
+        "max_error_px": max(errors) if len(errors) > 0 else 0,
+        "mean_error_px": float(np.mean(errors)) if len(errors) > 0 else 0.0,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare montage batching with per-page requests on synthetic pages.")
+    parser.add_argument("--pages", type=int, default=12)
+    parser.add_argument("--problems", type=int, default=9)
+    parser.add_argument("--max-pages", type=int, default=4)
+    parser.add_argument("--page-height", type=int, default=768)
+    args = parser.parse_args()
+
+    print(asyncio.run(compare(args.pages, args.problems, args.max_pages, args.page_height)))
@@ -0,0 +1,104 @@
+# Bytes saved by encode_for_budget, and whether detection is unchanged, validated against recorded responses
+#
+# Usage:
+#   python benchmarks/payload_budget.py --input-directory jpg --max-bytes 60000 30000 --record   # once, with provider credentials
+#   python benchmarks/payload_budget.py --input-directory jpg --max-bytes 60000 30000            # offline
+#
+# For each page, the original JPEG and the budget encoding are both sent with get_detected_solution_upper_bounds
+# through ReplayLLM, and the bounds found are compared. In replay mode, pages whose responses were never
+# recorded are counted as missing.
+
+# Imports
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from assignment import Assignment
+from page_manifest import index_directory
+from payload import encode_for_budget
+from replay import DEFAULT_FIXTURE_DIRECTORY, RECORD, REPLAY, MissingFixtureError, ReplayLLM, install_replay, uninstall_replay
+from upper_bounds import SUPPORTED_IMAGE_FORMATS, get_detected_solution_upper_bounds
+
+
+def bound_error(original: Dict[str, int], optimized: Dict[str, int]) -> int|None:
+    """
+    Largest difference between the bounds found for the same problems, or None if different problems were found.
+    """
+    if set(original.keys()) != set(optimized.keys()):
+        return None
+    return max([abs(original[problem] - optimized[problem]) for problem in original.keys()], default=0)
+
+
+async def validate(assignments: List[Assignment], max_bytes: int, tolerance: int) -> Dict[str, float]:
+
+    sizes = []
+    saved = []
+    formats: Dict[str, int] = {}
+    errors = []
+    mismatched = 0
+    missing = 0
+
+    for assignment in assignments:
+        for page in assignment.pages:
+            original = page.payload
+            optimized = encode_for_budget(page.pil_image, max_bytes=max_bytes, formats=SUPPORTED_IMAGE_FORMATS, source_bytes=len(original))
+            sizes.append(len(optimized))
+            saved.append(optimized.bytes_saved)
+            formats[f"{optimized.format}:{optimized.quality}"] = formats.get(f"{optimized.format}:{optimized.quality}", 0) + 1
+            page.unload()
+            try:
+                responses = [await get_detected_solution_upper_bounds(image_bytes=payload) for payload in (original, optimized)]
+            except MissingFixtureError:
+                missing += 1
+                continue
+            found = [{upper_bound.solution_number: upper_bound.upper_bound for upper_bound in response.structured_response.upper_bounds} for response in responses]
+            error = bound_error(found[0], found[1])
+            if error is None or error > tolerance:
+                mismatched += 1
+                print(f"-- {page.page_name}: {found[0]} became {found[1]} as {optimized.format} {optimized.quality}")
+            if error is not None:
+                errors.append(error)
+
+    return {
+        "max_bytes": max_bytes,
+        "pages": len(sizes),
+        "mean_bytes": statistics.mean(sizes) if len(sizes) > 0 else 0,
+        "mean_bytes_saved": statistics.mean(saved) if len(saved) > 0 else 0,
+        "bytes_saved_fraction": sum(saved) / (sum(saved) + sum(sizes)) if len(sizes) > 0 else 0,
+        "formats": formats,
+        "compared": len(sizes) - missing,
+        "missing": missing,
+        "mismatched": mismatched,
+        "max_error": max(errors, default=0),
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure bytes saved by budget encoding and validate detection against recorded responses.")
+    parser.add_argument("--input-directory", default="jpg")
+    parser.add_argument("--assignments", nargs="*", default=[], help="Only these assignments, every assignment in the directory if omitted")
+    parser.add_argument("--image-height", default="768")
+    parser.add_argument("--max-bytes", type=int, nargs="*", default=[60000, 30000])
+    parser.add_argument("--tolerance", type=int, default=10, help="Largest accepted change of a bound, normalized by 1000")
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURE_DIRECTORY)
+    parser.add_argument("--record", action="store_true", help="Send requests to the provider and write fixtures")
+    args = parser.parse_args()
+
+    # Index the directory, in case it was written before manifests existed
+    manifest = index_directory(args.input_directory)
+    assignment_names = args.assignments if len(args.assignments) > 0 else manifest.assignment_names()
+    assignments = [Assignment(assignment_name=assignment_name, input_directory=args.input_directory, problem_numbers=[], image_height=args.image_height) for assignment_name in assignment_names]
+
+    previous = install_replay(ReplayLLM(fixture_directory=args.fixtures, mode=RECORD if args.record else REPLAY, latency_scale=0.0))
+    try:
+        for max_bytes in args.max_bytes:
+            print(asyncio.run(validate(assignments, max_bytes=max_bytes, tolerance=args.tolerance)))
+    finally:
+        uninstall_replay(previous)
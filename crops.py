@@ -0,0 +1,203 @@
+# Per-problem crops of assignments, stitched across page breaks
+#
+# Follows separate_problems in bb04_upper_bound_individual.ipynb: a problem runs from its upper bound to the
+# next problem on the same page, and the last problem on a page continues through the following pages up to
+# the first problem found on a later page. Segments are stacked top to bottom, padded with black on the right.
+
+# Imports
+
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from pydantic import BaseModel
+from typing import Dict, List
+
+from assignment import Assignment, Page
+from instrumentation import span
+from util import convert_pil_image_to_bytes
+
+
+CROPS_INDEX_FILE = "crops_index.json"
+
+
+class CropSegment(BaseModel):
+    """Rows of one page that belong to a problem, in pixels."""
+    page_index: int
+    page_name: str
+    top: int
+    bottom: int
+
+
+class CropRecord(BaseModel):
+    """One problem crop written by export_crops."""
+    assignment_name: str
+    problem_number: str
+    file_name: str
+    width: int = 0
+    height: int = 0
+    segments: List[CropSegment]
+
+
+def crop_file_name(assignment_name: str, problem_number: str, index: int|None=None) -> str:
+    # Problem numbers such as "2." or "3)" are reduced to letters, digits and underscores.
+    # index tells apart problem numbers that reduce to the same name
+    name = re.sub(r'[^0-9A-Za-z]+', '_', problem_number).strip('_')
+    return f"{assignment_name}_{name}.jpg" if index is None else f"{assignment_name}_{name}_{index:02d}.jpg"
+
+
+########
+def plan_crops(assignment: Assignment) -> List[CropRecord]:
+    """
+    Work out the page segments of every problem from found_problems, without decoding any page.
+    A problem found on more than one page keeps the last one, as in separate_problems.
+    Args:
+        assignment (Assignment): An assignment after find_problem_positions.
+    Returns:
+        List[CropRecord]: One record per problem, in the order the problems close.
+    """
+    records: Dict[str, CropRecord] = {}
+    open_record: CropRecord|None = None
+
+    def add_segment(record: CropRecord, page_index: int, page: Page, top: int, bottom: int) -> None:
+        if bottom > top:
+            record.segments.append(CropSegment(page_index=page_index, page_name=page.page_name, top=top, bottom=bottom))
+
+    def close(record: CropRecord) -> None:
+        records.pop(record.problem_number, None)
+        records[record.problem_number] = record
+
+    for k1, page in enumerate(assignment.pages):
+        page_height = page.image_size[1]
+        sorted_problems = sorted(page.found_problems.items(), key=lambda problem: problem[1])
+
+        # A page without problems continues the open problem
+        if len(sorted_problems) == 0:
+            if open_record is not None:
+                add_segment(open_record, k1, page, 0, page_height)
+            continue
+
+        # The open problem ends at the first problem on this page
+        if open_record is not None:
+            add_segment(open_record, k1, page, 0, sorted_problems[0][1])
+            close(open_record)
+            open_record = None
+
+        for k2, (problem_number, top) in enumerate(sorted_problems):
+            record = CropRecord(assignment_name=assignment.assignment_name, problem_number=problem_number, file_name=crop_file_name(assignment.assignment_name, problem_number), segments=[])
+            if k2 < len(sorted_problems) - 1:
+                add_segment(record, k1, page, top, sorted_problems[k2 + 1][1])
+                close(record)
+            else:
+                add_segment(record, k1, page, top, page_height)
+                open_record = record
+
+    if open_record is not None:
+        close(open_record)
+
+    # Problem numbers that differ only in punctuation (e.g. "2." and "2)") would overwrite each other's crop
+    planned = [record for record in records.values() if len(record.segments) > 0]
+    file_name_counts: Dict[str, int] = {}
+    for record in planned:
+        file_name_counts[record.file_name] = file_name_counts.get(record.file_name, 0) + 1
+    for k1, record in enumerate(planned):
+        if file_name_counts[record.file_name] > 1:
+            record.file_name = crop_file_name(assignment.assignment_name, record.problem_number, index=k1)
+    return planned
+
+
+def stitch_segments(segment_images: List[Image.Image]) -> Image.Image:
+    """
+    Stack segment images top to bottom, padding narrower ones with black on the right.
+    """
+    width = max(segment_image.width for segment_image in segment_images)
+    stitched_image = Image.new("L", (width, sum(segment_image.height for segment_image in segment_images)))
+    y_offset = 0
+    for segment_image in segment_images:
+        stitched_image.paste(segment_image, (0, y_offset))
+        y_offset += segment_image.height
+    return stitched_image
+
+
+def export_assignment_crops(assignment: Assignment, output_directory: str, quality: int=95) -> List[CropRecord]:
+    """
+    Write one JPEG per problem of an assignment.
+    Pages are decoded once, in order, and released once the page after them has been cut, so at most two
+    pages are decoded at a time. A page already decoded by the caller is used as is and kept. Only the rows of
+    problems still open across a page break are kept. Crops are encoded as they close and written together
+    at the end.
+    Args:
+        assignment (Assignment): An assignment after find_problem_positions.
+        output_directory (str): The directory to write crops to.
+        quality (int, optional): The JPEG quality of the crops.
+    Returns:
+        List[CropRecord]: The crops written.
+    """
+    records = plan_crops(assignment)
+
+    # Segments to cut from each page, and the page on which each crop is complete
+    segments_by_page: Dict[int, List[tuple]] = {}
+    for record in records:
+        for segment in record.segments:
+            segments_by_page.setdefault(segment.page_index, []).append((record, segment))
+
+    segment_images: Dict[str, List[Image.Image]] = {record.problem_number: [] for record in records}
+    last_page = {record.problem_number: record.segments[-1].page_index for record in records}
+    encoded: Dict[str, bytes] = {}
+    decoded_by_caller = [page.is_decoded for page in assignment.pages]
+
+    for k1, page in enumerate(assignment.pages):
+        for record, segment in segments_by_page.get(k1, []):
+            with span("crop", page=page.page_name):
+                segment_images[record.problem_number].append(page.pil_image.crop((0, segment.top, page.pil_image.width, segment.bottom)))
+            if last_page[record.problem_number] == k1:
+                crop_image = stitch_segments(segment_images.pop(record.problem_number))
+                record.width, record.height = crop_image.size
+                encoded[record.file_name] = convert_pil_image_to_bytes(pil_image=crop_image, format="JPEG", quality=quality)
+        if k1 >= 1 and not decoded_by_caller[k1 - 1]:
+            assignment.pages[k1 - 1].unload()
+    if len(assignment.pages) > 0 and not decoded_by_caller[-1]:
+        assignment.pages[-1].unload()
+
+    os.makedirs(output_directory, exist_ok=True)
+    for file_name, image_bytes in encoded.items():
+        with span("write", bytes_out=len(image_bytes)):
+            with open(os.path.join(output_directory, file_name), "wb") as f:
+                f.write(image_bytes)
+
+    return records
+
+
+def export_crops(assignments: List[Assignment], output_directory: str, quality: int=95, workers: int|None=None) -> List[CropRecord]:
+    """
+    Export the crops of many assignments in parallel, then update the index of every crop in the directory.
+    Entries of the assignments exported replace their previous entries; entries of other assignments are kept.
+    Assignments run on a thread pool: decoding, cropping and encoding happen in Pillow, outside the GIL,
+    and the assignments' found problems and already decoded pages are used without copying them to other processes.
+    Args:
+        assignments (List[Assignment]): Assignments after find_problem_positions.
+        output_directory (str): The directory to write crops and crops_index.json to.
+        quality (int, optional): The JPEG quality of the crops.
+        workers (int, optional): Number of threads. Defaults to the thread pool default.
+    Returns:
+        List[CropRecord]: Every crop written, by assignment.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda assignment: export_assignment_crops(assignment, output_directory, quality=quality), assignments))
+
+    records = [record for assignment_records in results for record in assignment_records]
+
+    index_path = os.path.join(output_directory, CROPS_INDEX_FILE)
+    index = []
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    exported = {assignment.assignment_name for assignment in assignments}
+    index = [entry for entry in index if entry["assignment_name"] not in exported] + [record.model_dump() for record in records]
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(f"{index_path}.tmp", index_path)
+
+    print(f"Wrote {len(records)} crops for {len(assignments)} assignments to {output_directory}")
+    return records
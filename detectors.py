@@ -0,0 +1,223 @@
+# Detector backends that find the upper bound of each problem on each page
+#
+# LLMDetector sends pages to the LLM (see upper_bounds.py). YOLODetector runs a local object detector,
+# trained on Label Studio exports of our page images, that finds boxed or circled problem labels.
+# Both return NumberedSolutionUpperBounds, one per page, normalized by 1000.
+
+# Imports
+
+import asyncio
+import json
+import os
+import random
+import shutil
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List
+
+from assignment import Page, upper_bounds_system_prompt, upper_bounds_user_prompt
+from response_cache import ResponseCache
+from upper_bounds import (
+    NumberedSolutionUpperBound,
+    NumberedSolutionUpperBounds,
+    get_numbered_solution_upper_bounds,
+)
+
+
+DEFAULT_LABEL_MODEL = os.path.join("models", "problem_labels.onnx")
+LABEL_CLASS = "problem_label"
+
+
+class DetectorBackend(ABC):
+    """
+    Finds the upper bound of each problem on each page of an assignment.
+    """
+
+    @abstractmethod
+    async def detect(self, pages: List[Page], solution_numbers: List[str]) -> List[NumberedSolutionUpperBounds|BaseException]:
+        """
+        Args:
+            pages (List[Page]): The pages of one assignment, in page order.
+            solution_numbers (List[str]): The problem numbers of the assignment, in order.
+        Returns:
+            List[NumberedSolutionUpperBounds | BaseException]: For each page, an upper bound per problem number, in the
+            order of solution_numbers, normalized by 1000, with -1 for problems not on that page. A page that
+            failed gets its exception instead, so it does not stop the other pages.
+        """
+
+
+class LLMDetector(DetectorBackend):
+    """
+    Sends each page to the LLM with get_numbered_solution_upper_bounds.
+    """
+
+    def __init__(self, max_concurrency: int=8, cache: ResponseCache|None=None):
+        self.max_concurrency = max_concurrency
+        self.cache = cache
+
+    async def detect(self, pages: List[Page], solution_numbers: List[str]) -> List[NumberedSolutionUpperBounds|BaseException]:
+
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+
+        async def request(page: Page) -> NumberedSolutionUpperBounds:
+            async with semaphore:
+                response = await get_numbered_solution_upper_bounds(
+                    image_bytes=await page.load_payload(),
+                    system_prompt=upper_bounds_system_prompt(),
+                    user_prompt=upper_bounds_user_prompt(solution_numbers),
+                    solution_numbers=solution_numbers,
+                    cache=self.cache,
+                )
+            return response.structured_response
+
+        return await asyncio.gather(*[request(page) for page in pages], return_exceptions=True)
+
+
+class YOLODetector(DetectorBackend):
+    """
+    Finds boxed or circled problem labels with a local YOLO model exported to ONNX, on the CPU.
+    The model has a single class and does not read the label text, so labels are read top to bottom
+    across the pages of an assignment and assigned to the problem numbers in order. A missed or extra
+    label would shift every later problem, so when the number of labels found differs from the number of
+    problems the assignment is sent to the fallback detector instead (the LLM by default).
+    """
+
+    def __init__(self, model_path: str=DEFAULT_LABEL_MODEL, confidence: float=0.25, batch_size: int=16, image_size: int=640, fallback: DetectorBackend|None=None):
+        self.model_path = model_path
+        self.confidence = confidence
+        self.batch_size = batch_size
+        self.image_size = image_size
+        self.fallback = fallback if fallback is not None else LLMDetector()
+        self.failovers = 0
+        self._model = None
+
+    @property
+    def model(self) -> Any:
+        if self._model is None:
+            from ultralytics import YOLO
+            self._model = YOLO(self.model_path, task="detect")
+        return self._model
+
+    def find_labels(self, pages: List[Page]) -> List[List[int]]:
+        """
+        Run the detector on pages in batches.
+        Returns:
+            List[List[int]]: For each page, the top of each label found, normalized by 1000, top to bottom.
+        """
+        labels = []
+        for k1 in range(0, len(pages), self.batch_size):
+            images = [page.pil_image.convert("RGB") for page in pages[k1:k1 + self.batch_size]]
+            results = self.model.predict(images, imgsz=self.image_size, conf=self.confidence, device="cpu", verbose=False)
+            for image, result in zip(images, results):
+                tops = sorted(float(box[1]) for box in result.boxes.xyxy.tolist())
+                labels.append([int(top / image.height * 1000) for top in tops])
+        return labels
+
+    async def detect(self, pages: List[Page], solution_numbers: List[str]) -> List[NumberedSolutionUpperBounds|BaseException]:
+
+        labels = await asyncio.to_thread(self.find_labels, pages)
+
+        # Labels can only be matched to problem numbers by position when there is exactly one per problem
+        label_count = sum(len(page_labels) for page_labels in labels)
+        if label_count != len(solution_numbers):
+            self.failovers += 1
+            print(f"-- Found {label_count} labels for {len(solution_numbers)} problems, using {type(self.fallback).__name__}")
+            return await self.fallback.detect(pages, solution_numbers)
+
+        # Assign labels to problem numbers in reading order
+        results = []
+        k2 = 0
+        for page_labels in labels:
+            upper_bounds = [NumberedSolutionUpperBound(solution_number=solution_number, upper_bound=-1) for solution_number in solution_numbers]
+            for top in page_labels:
+                upper_bounds[k2].upper_bound = top
+                k2 += 1
+            results.append(NumberedSolutionUpperBounds(upper_bounds=upper_bounds))
+        return results
+
+
+########
+def convert_label_studio_export(export_path: str, image_directory: str, output_directory: str, val_fraction: float=0.2, seed: int=0) -> str:
+    """
+    Convert a Label Studio JSON export of rectangle labels on our page images to a YOLO dataset.
+    Every rectangle is one class, problem_label. Images are matched by file name in image_directory,
+    ignoring the prefix Label Studio adds to uploaded files.
+    Args:
+        export_path (str): The Label Studio JSON export.
+        image_directory (str): The directory containing the page images (e.g. jpg).
+        output_directory (str): The directory to write the dataset to.
+        val_fraction (float, optional): Fraction of images held out for validation.
+        seed (int, optional): Seed of the train/validation split.
+    Returns:
+        str: The path of the dataset YAML file, for train_label_detector.
+    """
+    with open(export_path, "r") as f:
+        tasks = json.load(f)
+
+    image_files = set(os.listdir(image_directory))
+    generator = random.Random(seed)
+
+    for split in ("train", "val"):
+        os.makedirs(os.path.join(output_directory, "images", split), exist_ok=True)
+        os.makedirs(os.path.join(output_directory, "labels", split), exist_ok=True)
+
+    converted = 0
+    for task in tasks:
+        # Uploaded files are named <hash>-<original name>
+        file_name = os.path.basename(task["data"]["image"])
+        if file_name not in image_files and "-" in file_name:
+            file_name = file_name.split("-", 1)[1]
+        if file_name not in image_files:
+            print(f"-- Image {file_name} not found in {image_directory}, skipping")
+            continue
+
+        lines = []
+        for annotation in task.get("annotations", [])[:1]:
+            for result in annotation.get("result", []):
+                if result.get("type") != "rectanglelabels":
+                    continue
+                value = result["value"]
+                # Label Studio uses percentages of the image size, from the top left corner
+                width = value["width"] / 100
+                height = value["height"] / 100
+                x_center = value["x"] / 100 + width / 2
+                y_center = value["y"] / 100 + height / 2
+                lines.append(f"0 {x_center:.6f} {y_center:.6f} {width:.6f} {height:.6f}")
+
+        split = "val" if generator.random() < val_fraction else "train"
+        shutil.copy(os.path.join(image_directory, file_name), os.path.join(output_directory, "images", split, file_name))
+        with open(os.path.join(output_directory, "labels", split, f"{file_name.rsplit('.', 1)[0]}.txt"), "w") as f:
+            f.write("\n".join(lines) + ("\n" if len(lines) > 0 else ""))
+        converted += 1
+
+    data_path = os.path.join(output_directory, "data.yaml")
+    with open(data_path, "w") as f:
+        f.write(f"path: {os.path.abspath(output_directory)}\ntrain: images/train\nval: images/val\nnames:\n  0: {LABEL_CLASS}\n")
+
+    print(f"Converted {converted} of {len(tasks)} labelled images to {output_directory}")
+    return data_path
+
+
+def train_label_detector(data_path: str, base_model: str="yolov8n.pt", epochs: int=100, image_size: int=640, output_path: str=DEFAULT_LABEL_MODEL) -> Dict[str, float]:
+    """
+    Train the problem label detector and export it to ONNX for batched CPU inference.
+    Args:
+        data_path (str): The dataset YAML file, from convert_label_studio_export.
+        base_model (str, optional): The pretrained YOLO weights to start from.
+        epochs (int, optional): Number of training epochs.
+        image_size (int, optional): Training and inference image size.
+        output_path (str, optional): Where to write the ONNX model.
+    Returns:
+        Dict[str, float]: Validation metrics of the trained model.
+    """
+    from ultralytics import YOLO
+
+    model = YOLO(base_model)
+    model.train(data=data_path, epochs=epochs, imgsz=image_size, device="cpu")
+    metrics = model.val(data=data_path, imgsz=image_size, device="cpu")
+
+    # Dynamic batch size, so YOLODetector can send several pages per inference
+    exported_path = model.export(format="onnx", imgsz=image_size, dynamic=True)
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    shutil.copy(exported_path, output_path)
+
+    return {key: float(value) for key, value in metrics.results_dict.items()}
@@ -0,0 +1,88 @@
+# Offline stand-in for llm_structured, used to exercise the detection pipeline without a provider
+
+# Imports
+
+import asyncio
+import random
+from pydantic import BaseModel
+from typing import Any, Callable, List, Optional
+
+import upper_bounds
+
+
+class FakeProviderError(Exception):
+    """Error raised by FakeLLM to simulate a provider failure, with an HTTP status code."""
+
+    def __init__(self, status_code: int, message: str=""):
+        super().__init__(f"{status_code} {message}".strip())
+        self.status_code = status_code
+
+
+class FakeLLMResponse():
+
+    def __init__(self, structured_response: BaseModel):
+        self.structured_response = structured_response
+
+
+class FakeLLM():
+    """
+    Callable with the same signature as llm_structured.
+    The handler receives the request messages and response model and returns the structured response.
+    Latency, slow tail requests and provider errors can be injected to exercise the scheduler.
+    Args:
+        handler (Callable): Returns the structured response for the messages and response model.
+        latency (float, optional): Seconds each call takes.
+        latency_jitter (float, optional): Extra seconds added to each call, uniform between 0 and this.
+        tail_rate (float, optional): Fraction of calls that are slow.
+        tail_latency (float, optional): Extra seconds added to slow calls.
+        error_rate (float, optional): Fraction of calls that fail with a FakeProviderError.
+        error_status_codes (List[int], optional): Status codes of injected errors, chosen at random.
+        seed (int, optional): Seed of the injected latencies and errors.
+    """
+
+    def __init__(self, handler: Callable[[List[Any], type], BaseModel], latency: float=0.0, latency_jitter: float=0.0, tail_rate: float=0.0, tail_latency: float=0.0, error_rate: float=0.0, error_status_codes: List[int]=[429, 503], seed: int|None=None):
+        self.handler = handler
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.error_rate = error_rate
+        self.error_status_codes = error_status_codes
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __call__(self, messages: List[Any], response_model: type, router: Any=None, **kwargs) -> FakeLLMResponse:
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            latency = self.latency + self.random.uniform(0, self.latency_jitter)
+            if self.random.random() < self.tail_rate:
+                latency += self.tail_latency
+            if latency > 0:
+                await asyncio.sleep(latency)
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                raise FakeProviderError(status_code=self.random.choice(self.error_status_codes), message="injected error")
+            return FakeLLMResponse(structured_response=self.handler(messages, response_model))
+        finally:
+            self.in_flight -= 1
+
+
+########
+def install_fake_llm(fake: Callable, module: Optional[Any]=None) -> Callable:
+    """
+    Replace llm_structured in upper_bounds with a fake.
+    Args:
+        fake (Callable): The replacement, usually a FakeLLM.
+        module (optional): The module to patch. Defaults to upper_bounds.
+    Returns:
+        Callable: The previous llm_structured, so it can be restored.
+    """
+    module = upper_bounds if module is None else module
+    previous = module.llm_structured
+    module.llm_structured = fake
+    return previous
@@ -0,0 +1,380 @@
+# Batch ingestion of a directory of PDFs into page JPEGs, spread across a process pool
+#
+# Usage:
+#   python ingest.py --manifest pdf_manifest.json --input-directory pdf --output-directory jpg
+#
+# The manifest maps assignment names (PDF file names without extension) to zero-based page lists,
+# like the pdfs dict in bb01_image_processing.ipynb. An empty list includes every page.
+# The pages written are indexed in manifest.sqlite in the output directory (see page_manifest.py).
+#
+# Rebuilds are incremental: every output is keyed on the hash of its PDF and the parameters that produce it,
+# recorded in ingest_state.json in the output directory. Outputs whose key is unchanged are skipped, only the
+# variants whose parameters changed are rebuilt, and outputs no longer produced by the manifest are removed.
+
+# Imports
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pydantic import BaseModel
+from typing import Any, Dict, List, Tuple
+
+from instrumentation import is_enabled, labels, merge, recording
+from page_manifest import index_directory, parse_page_file_name
+
+
+ORIGINAL_SUFFIX = "_original"
+BUILD_STATE_FILE = "ingest_state.json"
+
+# Bump when ingestion changes how outputs are produced, so every output is rebuilt
+BUILD_VERSION = 1
+
+# Defaults of ingest_page, used to key outputs on the parameters that produce them
+DEFAULT_PAGE_OPTIONS = {"dpi": 150, "quality": 100, "resize_quality": 96, "sharpen": True, "radius": 0.5, "strength": 150, "threshold": 2}
+
+
+class PageTask(BaseModel):
+    """One page of one PDF to ingest."""
+    assignment_name: str
+    page_number: int
+    page_index: int
+
+
+class IngestReport(BaseModel):
+    """Outputs written, outputs skipped as up to date, stale outputs removed, and pages (or unreadable PDFs) that failed after all retries."""
+    outputs: Dict[str, List[str]] = {}
+    up_to_date: Dict[str, List[str]] = {}
+    removed: List[str] = []
+    failed: Dict[str, str] = {}
+    seconds: float = 0.0
+    stage_seconds: Dict[str, float] = {}
+
+
+class BuildState(BaseModel):
+    """Keys of the outputs written to a directory, and cached hashes of their PDFs."""
+    sources: Dict[str, Dict[str, Any]] = {}
+    outputs: Dict[str, str] = {}
+
+
+def task_key(task: PageTask) -> str:
+    return f"{task.assignment_name}_{task.page_index:02d}"
+
+
+########
+def load_manifest(manifest_path: str) -> Dict[str, List[int]]:
+    """
+    Load an assignment to page list manifest.
+    Args:
+        manifest_path (str): Path to a JSON object mapping assignment names to page lists.
+    Returns:
+        Dict[str, List[int]]: The page lists, keyed by assignment name.
+    """
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    return {str(assignment_name): [int(page) for page in pages] for assignment_name, pages in manifest.items()}
+
+
+def manifest_from_directory(input_directory: str) -> Dict[str, List[int]]:
+    """
+    Build a manifest including every page of every PDF in a directory.
+    """
+    return {pdf.split(".pdf")[0]: [] for pdf in sorted(os.listdir(input_directory)) if pdf.endswith(".pdf")}
+
+
+def plan_page_tasks(input_directory: str, manifest: Dict[str, List[int]], failed: Dict[str, str]|None=None) -> List[PageTask]:
+    """
+    Expand a manifest into one task per page.
+    Pages are indexed by their position in the page list, which is the index used in output file names.
+    A PDF that cannot be read is skipped, so one corrupt file does not stop the others.
+    Args:
+        input_directory (str): The directory containing the PDFs.
+        manifest (Dict[str, List[int]]): Page lists keyed by assignment name.
+        failed (Dict[str, str], optional): Errors of the PDFs that could not be read are added here, keyed by assignment name.
+    Returns:
+        List[PageTask]: The tasks, sorted by assignment name and page index.
+    """
+    from pdf2image import pdfinfo_from_path
+
+    tasks = []
+    for assignment_name in sorted(manifest.keys()):
+        pdf_path = os.path.join(input_directory, f"{assignment_name}.pdf")
+        if not os.path.exists(pdf_path):
+            print(f"File {assignment_name}.pdf does not exist.")
+            continue
+        try:
+            page_count = pdfinfo_from_path(pdf_path)["Pages"]
+        except Exception as error:
+            print(f"-- Skipping {assignment_name}.pdf after error: {error!r}")
+            if failed is not None:
+                failed[assignment_name] = repr(error)
+            continue
+        pages = manifest[assignment_name]
+        if len(pages) >= 1:
+            pages = [k1 for k1 in pages if k1 < page_count]
+        else:
+            pages = list(range(page_count))
+        for page_index, page_number in enumerate(pages):
+            tasks.append(PageTask(assignment_name=assignment_name, page_number=page_number, page_index=page_index))
+    return tasks
+
+
+########
+def load_build_state(output_directory: str) -> BuildState:
+    path = os.path.join(output_directory, BUILD_STATE_FILE)
+    if not os.path.exists(path):
+        return BuildState()
+    with open(path, "r") as f:
+        return BuildState.model_validate(json.load(f))
+
+
+def save_build_state(state: BuildState, output_directory: str) -> None:
+    path = os.path.join(output_directory, BUILD_STATE_FILE)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state.model_dump(), f, indent=1, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def source_hash(state: BuildState, input_directory: str, assignment_name: str) -> str:
+    """
+    SHA-256 of an assignment's PDF. The hash is cached in the build state and only recomputed
+    when the file's size or modification time changes.
+    """
+    pdf_path = os.path.join(input_directory, f"{assignment_name}.pdf")
+    stat = os.stat(pdf_path)
+    cached = state.sources.get(assignment_name)
+    if cached is not None and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+        return cached["sha256"]
+
+    hasher = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    state.sources[assignment_name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": hasher.hexdigest()}
+    return state.sources[assignment_name]["sha256"]
+
+
+def plan_outputs(task: PageTask, source_sha256: str, heights: List[int], options: Dict[str, Any]) -> Dict[str, str]:
+    """
+    The outputs of a page and the key of each: a hash of the PDF, the page and only the parameters that
+    affect that output, so changing e.g. resize_quality only rebuilds the resized variants.
+    Args:
+        task (PageTask): The page.
+        source_sha256 (str): Hash of the PDF, see source_hash.
+        heights (List[int]): Heights of the resized variants.
+        options (Dict[str, Any]): Page options, DEFAULT_PAGE_OPTIONS overridden by those passed to ingest.
+    Returns:
+        Dict[str, str]: Output keys, keyed by file name.
+    """
+    page_stem = task_key(task)
+    sharpening = {name: options[name] for name in ("radius", "strength", "threshold", "quality")}
+
+    variants = {f"{page_stem}{ORIGINAL_SUFFIX}.jpg": {"quality": options["quality"]}}
+    if options["sharpen"]:
+        variants[f"{page_stem}{ORIGINAL_SUFFIX}_sharpened.jpg"] = {"sharpen": sharpening}
+    for height in heights:
+        variants[f"{page_stem}_{height}.jpg"] = {"height": height, "resize_quality": options["resize_quality"]}
+        if options["sharpen"]:
+            variants[f"{page_stem}_{height}_sharpened.jpg"] = {"height": height, "sharpen": sharpening}
+
+    keys = {}
+    for file_name, parameters in variants.items():
+        inputs = {"version": BUILD_VERSION, "source": source_sha256, "page_number": task.page_number, "dpi": options["dpi"], **parameters}
+        keys[file_name] = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+    return keys
+
+
+def stale_outputs(state: BuildState, manifest: Dict[str, List[int]], planned: set, input_directory: str) -> List[str]:
+    """
+    Outputs recorded in the build state that are no longer produced: outputs of assignments in the manifest
+    that are not planned (pages or heights dropped), and outputs of assignments whose PDF was removed.
+    Outputs of other assignments, and files not written by ingest, are left alone.
+    """
+    stale = []
+    for file_name in state.outputs.keys():
+        record = parse_page_file_name(file_name)
+        assignment_name = record.assignment_name if record is not None else None
+        if assignment_name in manifest and file_name not in planned:
+            stale.append(file_name)
+        elif assignment_name is not None and not os.path.exists(os.path.join(input_directory, f"{assignment_name}.pdf")):
+            stale.append(file_name)
+    return sorted(stale)
+
+
+########
+def ingest_page(task: PageTask, input_directory: str, output_directory: str, heights: List[int], dpi: int=150, quality: int=100, resize_quality: int=96, sharpen: bool=True, radius: float=0.5, strength: float=150, threshold: float=2, outputs: List[str]|None=None) -> Dict[str, Dict[str, float]]:
+    """
+    Rasterize one page and derive its resized and sharpened variants in memory (see derive_page_variants).
+    Output names match bb01_image_processing.ipynb, for example E_231_HW_02_00_original.jpg,
+    E_231_HW_02_00_768.jpg and E_231_HW_02_00_768_sharpened.jpg.
+    Args:
+        outputs (List[str], optional): Only write these file names. Defaults to every variant.
+    Returns:
+        Dict[str, Dict[str, float]]: Seconds spent per stage, keyed by file name written. Rasterization is under "rasterize" of the first file.
+    """
+    from util import derive_page_variants, iter_pdf_pages
+
+    page_stem = f"{task.assignment_name}_{task.page_index:02d}"
+
+    timings = {}
+    start = time.perf_counter()
+    for page_number, image in iter_pdf_pages(input_directory, task.assignment_name, pages=[task.page_number], dpi=dpi):
+        rasterize_seconds = time.perf_counter() - start
+        timings = derive_page_variants(image, output_directory, page_stem, heights=heights, original_suffix=ORIGINAL_SUFFIX, quality=quality, resize_quality=resize_quality, sharpen=sharpen, radius=radius, strength=strength, threshold=threshold, outputs=outputs)
+        if len(timings) > 0:
+            next(iter(timings.values()))["rasterize"] = rasterize_seconds
+
+    return timings
+
+
+def _ingest_page_recorded(instrument: bool, task: PageTask, *args, **kwargs) -> Tuple[Dict[str, Dict[str, float]], List[Dict[str, Any]]]:
+    # Spans opened in a worker process are returned with the result, for the parent to merge into its run
+    if not instrument:
+        return ingest_page(task, *args, **kwargs), []
+    with recording() as recorded, labels(assignment=task.assignment_name, page=task_key(task)):
+        timings = ingest_page(task, *args, **kwargs)
+    return timings, recorded
+
+
+def ingest(manifest: Dict[str, List[int]], input_directory: str="pdf", output_directory: str="jpg", heights: List[int]=[640, 768], workers: int|None=None, retries: int=1, force: bool=False, collect_garbage: bool=True, **page_options) -> IngestReport:
+    """
+    Ingest the pages listed in a manifest across a process pool.
+    Each page is an independent task, so a term's worth of PDFs spreads over all cores.
+    A page that fails is retried up to retries times and then skipped. A PDF that cannot be read is skipped,
+    and its outputs are left as they are.
+    When instrumentation is on, the spans of every page are merged into this process's run.
+    Only outputs that are missing, or whose PDF or parameters changed since they were written, are rebuilt (see plan_outputs).
+    Args:
+        manifest (Dict[str, List[int]]): Page lists keyed by assignment name.
+        input_directory (str, optional): The directory containing the PDFs.
+        output_directory (str, optional): The directory to write JPEGs to.
+        heights (List[int], optional): Heights of the resized variants.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        retries (int, optional): Number of times to retry a failed page.
+        force (bool, optional): Rebuild every output, even those that are up to date.
+        collect_garbage (bool, optional): Remove outputs of the manifest's assignments that are no longer produced, and outputs of removed PDFs.
+        page_options: Passed to ingest_page (dpi, quality, resize_quality, sharpen, radius, strength, threshold).
+    Returns:
+        IngestReport: Files written and up to date per assignment, files removed, and the pages (or whole PDFs, by assignment name) that failed.
+    """
+    start = time.perf_counter()
+    os.makedirs(output_directory, exist_ok=True)
+    options = {**DEFAULT_PAGE_OPTIONS, **page_options}
+    state = load_build_state(output_directory)
+
+    # Keep the pages with at least one output that is missing or was built from other inputs
+    planned: Dict[str, Dict[str, str]] = {}
+    tasks = []
+    report = IngestReport()
+    source_hashes: Dict[str, str] = {}
+    for task in plan_page_tasks(input_directory, manifest, failed=report.failed):
+        if task.assignment_name in report.failed:
+            continue
+        if task.assignment_name not in source_hashes:
+            try:
+                source_hashes[task.assignment_name] = source_hash(state, input_directory, task.assignment_name)
+            except Exception as error:
+                print(f"-- Skipping {task.assignment_name}.pdf after error: {error!r}")
+                report.failed[task.assignment_name] = repr(error)
+                continue
+        key = task_key(task)
+        planned[key] = plan_outputs(task, source_hashes[task.assignment_name], heights, options)
+        up_to_date = [file_name for file_name, output_key in planned[key].items() if not force and state.outputs.get(file_name) == output_key and os.path.exists(os.path.join(output_directory, file_name))]
+        if len(up_to_date) > 0:
+            report.up_to_date.setdefault(task.assignment_name, []).extend(up_to_date)
+        if len(up_to_date) < len(planned[key]):
+            tasks.append(task)
+    attempts = {task_key(task): 0 for task in tasks}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        def submit(task: PageTask):
+            attempts[task_key(task)] += 1
+            outputs = [file_name for file_name in planned[task_key(task)] if file_name not in report.up_to_date.get(task.assignment_name, [])]
+            return executor.submit(_ingest_page_recorded, is_enabled(), task, input_directory, output_directory, heights, outputs=outputs, **page_options)
+
+        pending = {submit(task): task for task in tasks}
+        completed = 0
+        while len(pending) > 0:
+            for future in as_completed(list(pending.keys())):
+                task = pending.pop(future)
+                key = task_key(task)
+                try:
+                    timings, recorded = future.result()
+                    merge(recorded)
+                except Exception as error:
+                    if attempts[key] <= retries:
+                        print(f"-- Retrying {key} after error: {error!r}")
+                        pending[submit(task)] = task
+                        continue
+                    report.failed[key] = repr(error)
+                    timings = {}
+                completed += 1
+                report.outputs.setdefault(task.assignment_name, []).extend(timings.keys())
+                for file_name in timings.keys():
+                    state.outputs[file_name] = planned[key][file_name]
+                for stages in timings.values():
+                    for stage, seconds in stages.items():
+                        report.stage_seconds[stage] = report.stage_seconds.get(stage, 0.0) + seconds
+                status = "failed" if key in report.failed else "ok"
+                print(f"[{completed}/{len(tasks)}] {key} {status}")
+
+    for outputs in (report.outputs, report.up_to_date):
+        for assignment_name in outputs:
+            outputs[assignment_name] = sorted(outputs[assignment_name])
+
+    if collect_garbage:
+        planned_files = {file_name for outputs in planned.values() for file_name in outputs}
+        # Outputs of PDFs that could not be read are kept until the PDF is fixed or removed
+        readable = {assignment_name: pages for assignment_name, pages in manifest.items() if assignment_name not in report.failed}
+        report.removed = stale_outputs(state, readable, planned_files, input_directory)
+        for file_name in report.removed:
+            path = os.path.join(output_directory, file_name)
+            if os.path.exists(path):
+                os.remove(path)
+            state.outputs.pop(file_name)
+        for assignment_name in list(state.sources.keys()):
+            if not os.path.exists(os.path.join(input_directory, f"{assignment_name}.pdf")):
+                state.sources.pop(assignment_name)
+    save_build_state(state, output_directory)
+
+    # Index every page in the directory, written or up to date, so assignments look them up instead of scanning the directory
+    index_directory(output_directory).close()
+
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+########
+def main(argv: List[str]|None=None) -> int:
+
+    parser = argparse.ArgumentParser(description="Convert PDFs to resized and sharpened page JPEGs using a process pool.")
+    parser.add_argument("--manifest", default="", help="JSON file mapping assignment names to page lists, every page of every PDF if omitted")
+    parser.add_argument("--input-directory", default="pdf")
+    parser.add_argument("--output-directory", default="jpg")
+    parser.add_argument("--heights", type=int, nargs="*", default=[640, 768])
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--retries", type=int, default=1, help="Number of times to retry a failed page before skipping it")
+    parser.add_argument("--dpi", type=int, default=150)
+    parser.add_argument("--force", action="store_true", help="Rebuild every output, even those that are up to date")
+    parser.add_argument("--no-gc", action="store_true", help="Keep outputs that are no longer produced")
+    args = parser.parse_args(argv)
+
+    manifest = load_manifest(args.manifest) if args.manifest != "" else manifest_from_directory(args.input_directory)
+    report = ingest(manifest, input_directory=args.input_directory, output_directory=args.output_directory, heights=args.heights, workers=args.workers, retries=args.retries, force=args.force, collect_garbage=not args.no_gc, dpi=args.dpi)
+
+    file_count = sum(len(outputs) for outputs in report.outputs.values())
+    up_to_date_count = sum(len(outputs) for outputs in report.up_to_date.values())
+    print(f"Wrote {file_count} files for {len(report.outputs)} assignments in {report.seconds:.1f} s, {up_to_date_count} up to date, {len(report.removed)} removed.")
+    print(f"Seconds per stage, summed over workers: { {stage: round(seconds, 2) for stage, seconds in report.stage_seconds.items()} }")
+    if len(report.failed) > 0:
+        print(f"Failed pages: {sorted(report.failed.keys())}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
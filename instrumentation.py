@@ -0,0 +1,244 @@
+# Per-stage timing and payload instrumentation
+#
+# Stages are wrapped in spans, either with the span context manager or the instrumented decorator.
+# Spans record their duration and optional bytes in/out, image size and model, and aggregate into
+# per-run histograms that can be exported as JSON lines. Instrumentation is off unless enable() is
+# called or BOUNDING_BOX_INSTRUMENT=1 is set; when off, span() returns a shared no-op span.
+# Spans recorded in worker processes are captured with recording() and merged into the parent's run with merge().
+
+# Imports
+
+import contextvars
+import functools
+import inspect
+import json
+import math
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+
+_enabled = os.environ.get("BOUNDING_BOX_INSTRUMENT", "") not in ("", "0")
+_run_id = uuid.uuid4().hex[:12]
+_records: List[Dict[str, Any]] = []
+_labels: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar("instrumentation_labels", default={})
+
+
+class Span():
+    """
+    One timed stage. Fields (bytes_in, bytes_out, width, height, model, ...) can be passed when
+    the span is opened or set while it runs with set().
+    """
+
+    __slots__ = ("name", "fields", "start")
+
+    def __init__(self, name: str, fields: Dict[str, Any]):
+        self.name = name
+        self.fields = fields
+        self.start = 0.0
+
+    def set(self, **fields) -> None:
+        self.fields.update(fields)
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        record = {"stage": self.name, "seconds": time.perf_counter() - self.start, **_labels.get(), **self.fields}
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        _records.append(record)
+
+
+class _NullSpan():
+    """Span used when instrumentation is off."""
+
+    __slots__ = ()
+
+    def set(self, **fields) -> None:
+        pass
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+########
+def enable(run_id: str|None=None) -> str:
+    """
+    Turn instrumentation on, starting a new run.
+    Args:
+        run_id (str, optional): Identifier of the run. A random one is used if not given.
+    Returns:
+        str: The run identifier.
+    """
+    global _enabled, _run_id
+    _enabled = True
+    _run_id = run_id if run_id is not None else uuid.uuid4().hex[:12]
+    _records.clear()
+    return _run_id
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def span(name: str, **fields) -> Span|_NullSpan:
+    """
+    Time a stage, e.g. `with span("encode", width=w, height=h) as s: ...; s.set(bytes_out=n)`.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, fields)
+
+
+def instrumented(name: str) -> Callable:
+    """
+    Decorator timing every call of a function or coroutine function as a span.
+    """
+    def decorator(function: Callable) -> Callable:
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await function(*args, **kwargs)
+                with Span(name, {}):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def labels(**values: str) -> Iterator[None]:
+    """
+    Attach labels (e.g. assignment=E_231_HW_02) to every span opened inside the block,
+    including spans in asyncio tasks started inside it.
+    """
+    token = _labels.set({**_labels.get(), **values})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+@contextmanager
+def recording() -> Iterator[List[Dict[str, Any]]]:
+    """
+    Record the spans of a block into the list yielded, e.g. in a worker process, to return them to the
+    parent process with the result. Instrumentation is on inside the block, and the spans are not kept
+    in this process's run.
+    """
+    global _enabled
+    was_enabled = _enabled
+    _enabled = True
+    start = len(_records)
+    recorded: List[Dict[str, Any]] = []
+    try:
+        yield recorded
+    finally:
+        recorded.extend(_records[start:])
+        del _records[start:]
+        _enabled = was_enabled
+
+
+def merge(recorded: List[Dict[str, Any]]) -> None:
+    """
+    Add spans recorded elsewhere (see recording) to the current run, if instrumentation is on.
+    """
+    if _enabled:
+        _records.extend(recorded)
+
+
+########
+def records() -> List[Dict[str, Any]]:
+    """
+    The spans recorded in the current run, in the order they finished.
+    """
+    return list(_records)
+
+
+def _percentile(sorted_values: List[float], quantile: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(quantile * len(sorted_values)))]
+
+
+def histograms(group_by: Tuple[str, ...]=()) -> List[Dict[str, Any]]:
+    """
+    Aggregate the spans of the current run per stage.
+    Durations are bucketed by powers of two milliseconds (bucket "4" holds spans of 2-4 ms).
+    Args:
+        group_by (Tuple[str, ...], optional): Labels or fields to group by in addition to the stage, e.g. ("assignment",).
+    Returns:
+        List[Dict]: One histogram per group, sorted by total seconds, largest first.
+    """
+    groups: Dict[Tuple, List[Dict[str, Any]]] = {}
+    for record in _records:
+        key = (record["stage"],) + tuple(record.get(name) for name in group_by)
+        groups.setdefault(key, []).append(record)
+
+    results = []
+    for key, group in groups.items():
+        seconds = sorted(record["seconds"] for record in group)
+        buckets: Dict[str, int] = {}
+        for value in seconds:
+            bucket = str(2 ** max(0, math.ceil(math.log2(max(value * 1000, 1e-9)))))
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+        results.append({
+            "run_id": _run_id,
+            "stage": key[0],
+            **{name: value for name, value in zip(group_by, key[1:])},
+            "count": len(group),
+            "errors": sum(1 for record in group if "error" in record),
+            "total_seconds": sum(seconds),
+            "mean_seconds": sum(seconds) / len(seconds),
+            "p50_seconds": _percentile(seconds, 0.50),
+            "p95_seconds": _percentile(seconds, 0.95),
+            "max_seconds": seconds[-1],
+            "bytes_in": sum(record.get("bytes_in", 0) for record in group),
+            "bytes_out": sum(record.get("bytes_out", 0) for record in group),
+            "buckets_ms": buckets,
+        })
+    return sorted(results, key=lambda result: result["total_seconds"], reverse=True)
+
+
+def export_jsonl(path: str, group_by: Tuple[str, ...]=(), include_spans: bool=False) -> int:
+    """
+    Append the histograms of the current run to a JSON lines file, and optionally every span.
+    Returns:
+        int: The number of lines written.
+    """
+    lines = [json.dumps({"type": "histogram", **histogram}) for histogram in histograms(group_by=group_by)]
+    if include_spans:
+        lines += [json.dumps({"type": "span", "run_id": _run_id, **record}, default=str) for record in _records]
+    with open(path, "a") as f:
+        f.write("".join(f"{line}\n" for line in lines))
+    return len(lines)
+
+
+def summary(group_by: Tuple[str, ...]=()) -> None:
+    """
+    Print the histograms of the current run, largest total time first.
+    """
+    for histogram in histograms(group_by=group_by):
+        group = " ".join(str(histogram[name]) for name in group_by)
+        print(f"{histogram['stage']:<12} {group} count={histogram['count']} total={histogram['total_seconds']:.3f}s p50={histogram['p50_seconds'] * 1000:.1f}ms p95={histogram['p95_seconds'] * 1000:.1f}ms bytes_in={histogram['bytes_in']} bytes_out={histogram['bytes_out']}")
@@ -0,0 +1,206 @@
+# Pack several pages into one montage image per LLM request and map the results back to each page
+
+# Imports
+
+import asyncio
+from PIL import Image
+from pydantic import BaseModel
+from typing import Any, List, Tuple
+
+from assignment import Assignment, upper_bounds_system_prompt, upper_bounds_user_prompt
+from payload import ImagePayload
+from response_cache import ResponseCache
+from upper_bounds import (
+    NumberedSolutionUpperBound,
+    NumberedSolutionUpperBounds,
+    get_numbered_solution_upper_bounds,
+)
+
+
+class MontageTile(BaseModel):
+    """Position of one page in a montage, in montage pixels."""
+    page_index: int
+    y_offset: int
+    height: int
+    width: int
+
+
+class Montage():
+    """
+    Pages stacked vertically into one grayscale image, with the position of each page.
+    """
+
+    def __init__(self, pil_image: Image.Image, tiles: List[MontageTile], quality: int=90):
+        self.pil_image = pil_image
+        self.tiles = tiles
+        self.payload = ImagePayload.from_pil_image(pil_image, format="JPEG", quality=quality)
+
+
+    def locate(self, upper_bound: int) -> Tuple[MontageTile, int]|None:
+        """
+        Map a normalized upper bound on the montage to the page it falls on.
+        Args:
+            upper_bound (int): The y-axis position on the montage, normalized by 1000.
+        Returns:
+            Tuple[MontageTile, int]: The page tile and the position on that page, normalized by 1000. None if not found (-1).
+        """
+        if upper_bound < 0:
+            return None
+        montage_y = upper_bound / 1000 * self.pil_image.height
+        for tile in self.tiles:
+            if montage_y < tile.y_offset + tile.height or tile is self.tiles[-1]:
+                page_y = min(max(montage_y - tile.y_offset, 0), tile.height)
+                return tile, int(round(page_y / tile.height * 1000))
+        return None
+
+
+########
+def pack_pages(pil_images: List[Image.Image], max_pages: int=4, page_height: int=768, max_pixels: int=2048 * 2048, max_bytes: int=4 * 1024 * 1024, quality: int=90) -> List[Montage]:
+    """
+    Pack pages, in order, into montages of at most max_pages pages.
+    Each page is downscaled to page_height and pages are stacked vertically. A montage is closed
+    early when adding the next page would exceed max_pixels, or when its encoded size exceeds max_bytes.
+    Args:
+        pil_images (List[Image]): The page images, in page order.
+        max_pages (int, optional): The maximum number of pages per montage (N).
+        page_height (int, optional): The height of each page in the montage.
+        max_pixels (int, optional): The maximum number of pixels in a montage.
+        max_bytes (int, optional): The maximum encoded size of a montage.
+        quality (int, optional): The JPEG quality of the montage.
+    Returns:
+        List[Montage]: The montages, covering every page once, in page order.
+    """
+    # Downscale every page to the same height
+    scaled_images = []
+    for pil_image in pil_images:
+        pil_image = pil_image.convert("L")
+        new_width = int(pil_image.width * (page_height / pil_image.height))
+        scaled_images.append(pil_image.resize((new_width, page_height), Image.LANCZOS))
+
+    def build(page_indices: List[int]) -> Montage:
+        width = max(scaled_images[k1].width for k1 in page_indices)
+        combined_image = Image.new("L", (width, page_height * len(page_indices)), 255)
+        tiles = []
+        for k2, k1 in enumerate(page_indices):
+            combined_image.paste(scaled_images[k1], (0, k2 * page_height))
+            tiles.append(MontageTile(page_index=k1, y_offset=k2 * page_height, height=page_height, width=scaled_images[k1].width))
+        return Montage(pil_image=combined_image, tiles=tiles, quality=quality)
+
+    montages = []
+    current: List[int] = []
+    for k1, scaled_image in enumerate(scaled_images):
+        candidate = current + [k1]
+        width = max(scaled_images[k2].width for k2 in candidate)
+        if len(current) > 0 and (len(candidate) > max_pages or width * page_height * len(candidate) > max_pixels):
+            montages.append(build(current))
+            candidate = [k1]
+        current = candidate
+
+        # Split when the encoded montage is over the byte budget
+        if len(current) > 1 and len(build(current).payload) > max_bytes:
+            montages.append(build(current[:-1]))
+            current = [k1]
+    if len(current) > 0:
+        montages.append(build(current))
+
+    return montages
+
+
+def demultiplex_upper_bounds(montage: Montage, upper_bounds: List[NumberedSolutionUpperBound], solution_numbers: List[str]) -> List[List[NumberedSolutionUpperBound]]:
+    """
+    Translate upper bounds returned for a montage back to each of its pages.
+    Args:
+        montage (Montage): The montage sent to the LLM.
+        upper_bounds (List[NumberedSolutionUpperBound]): The upper bounds returned, in the order of solution_numbers.
+        solution_numbers (List[str]): The problem numbers requested.
+    Returns:
+        List[List[NumberedSolutionUpperBound]]: For each tile, upper bounds in the order of solution_numbers,
+        normalized to the page, with -1 for problems that are not on that page.
+    Raises:
+        ValueError: If the response does not have one upper bound per problem number.
+    """
+    if len(upper_bounds) != len(solution_numbers):
+        raise ValueError(f"Expected {len(solution_numbers)} upper bounds for the montage, got {len(upper_bounds)}")
+
+    per_tile = [[NumberedSolutionUpperBound(solution_number=solution_number, upper_bound=-1) for solution_number in solution_numbers] for tile in montage.tiles]
+    for k2 in range(0, len(solution_numbers)):
+        located = montage.locate(upper_bounds[k2].upper_bound)
+        if located is None:
+            continue
+        tile, page_upper_bound = located
+        per_tile[montage.tiles.index(tile)][k2].upper_bound = page_upper_bound
+    return per_tile
+
+
+class MontageResponse():
+    """Per-page slice of a montage response, shaped like an llm_structured response."""
+
+    def __init__(self, structured_response: BaseModel, montage_response: Any):
+        self.structured_response = structured_response
+        self.montage_response = montage_response
+
+
+async def find_problem_positions_batched(assignment: Assignment, max_pages: int=4, page_height: int=768, max_pixels: int=2048 * 2048, max_bytes: int=4 * 1024 * 1024, max_concurrency: int=1, cache: ResponseCache|None=None) -> int:
+    """
+    Find the problem positions of an assignment, sending several pages per request.
+    Pages are packed into montages (see pack_pages), each montage is sent with
+    get_numbered_solution_upper_bounds, and the bounds are written back to each page's
+    found_problems and found_problems_normalized as if the page had been sent alone.
+    A montage whose request fails keeps the exception in page.error of each of its pages. A montage
+    whose response cannot be mapped back to its pages (e.g. too few upper bounds) falls back to
+    one request per page, as in find_problem_positions.
+    Args:
+        assignment (Assignment): An assignment with known problem numbers.
+        max_pages, page_height, max_pixels, max_bytes: See pack_pages.
+        max_concurrency (int, optional): Maximum number of LLM requests in flight.
+        cache (ResponseCache, optional): Cache of LLM responses.
+    Returns:
+        int: The number of requests made, including per-page fallbacks.
+    """
+    montages = pack_pages([page.pil_image for page in assignment.pages], max_pages=max_pages, page_height=page_height, max_pixels=max_pixels, max_bytes=max_bytes)
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def request(montage: Montage) -> Any:
+        async with semaphore:
+            return await get_numbered_solution_upper_bounds(
+                image_bytes=montage.payload,
+                system_prompt=upper_bounds_system_prompt(),
+                user_prompt=upper_bounds_user_prompt(assignment.problem_numbers),
+                solution_numbers=assignment.problem_numbers,
+                cache=cache,
+            )
+
+    responses = await asyncio.gather(*[request(montage) for montage in montages], return_exceptions=True)
+
+    # Write results back in page order
+    fallback_pages = []
+    for montage, response in zip(montages, responses):
+        if isinstance(response, BaseException):
+            for tile in montage.tiles:
+                assignment.pages[tile.page_index].error = response
+                print(f"-- Failed to find problem positions on page {assignment.pages[tile.page_index].page_name}: {response!r}")
+            continue
+        try:
+            per_tile = demultiplex_upper_bounds(montage, response.structured_response.upper_bounds, assignment.problem_numbers)
+            for tile, upper_bounds in zip(montage.tiles, per_tile):
+                page = assignment.pages[tile.page_index]
+                page_response = MontageResponse(structured_response=NumberedSolutionUpperBounds(upper_bounds=upper_bounds), montage_response=response)
+                assignment._apply_response(page=page, response=page_response, solution_numbers=assignment.problem_numbers)
+                page.detection_mode = "montage"
+        except Exception as error:
+            print(f"-- Failed to read montage of pages {[tile.page_index for tile in montage.tiles]} ({error!r}), sending them one at a time")
+            fallback_pages += [assignment.pages[tile.page_index] for tile in montage.tiles]
+
+    # Pages of unreadable montages, one request each
+    results = await asyncio.gather(*[assignment._request_page_upper_bounds(page=page, semaphore=semaphore, cache=cache) for page in fallback_pages], return_exceptions=True)
+    for page, result in zip(fallback_pages, results):
+        try:
+            if isinstance(result, BaseException):
+                raise result
+            response, solution_numbers = result
+            assignment._apply_response(page=page, response=response, solution_numbers=solution_numbers)
+        except Exception as error:
+            page.error = error
+            print(f"-- Failed to find problem positions on page {page.page_name}: {error!r}")
+
+    return len(montages) + len(fallback_pages)
@@ -0,0 +1,175 @@
+# Index of page images by assignment, page, height and variant
+
+# Imports
+
+import os
+import re
+import sqlite3
+from pydantic import BaseModel
+from typing import Iterable, List
+
+
+MANIFEST_FILE = "manifest.sqlite"
+FULL_HEIGHT = "original"
+PLAIN_VARIANT = "plain"
+SHARPENED_VARIANT = "sharpened"
+
+# E_231_HW_02_00_768.jpg, E_231_HW_02_00_original_sharpened.jpg, ...
+PAGE_FILE_PATTERN = re.compile(r"^(?P<assignment_name>.+)_(?P<page_index>\d{2,})_(?P<height>\d+|original)(?P<sharpened>_sharpened)?\.jpg$")
+
+
+class PageRecord(BaseModel):
+    """One page image file."""
+    assignment_name: str
+    page_index: int
+    height: str
+    variant: str
+    file_name: str
+
+
+########
+def parse_page_file_name(file_name: str) -> PageRecord|None:
+    """
+    Parse a page image file name written by ingestion.
+    Args:
+        file_name (str): A file name such as E_231_HW_02_00_768_sharpened.jpg.
+    Returns:
+        PageRecord: The parsed record, or None if the name does not follow the page naming scheme.
+    """
+    match = PAGE_FILE_PATTERN.match(file_name)
+    if match is None:
+        return None
+    return PageRecord(
+        assignment_name=match.group("assignment_name"),
+        page_index=int(match.group("page_index")),
+        height=match.group("height"),
+        variant=SHARPENED_VARIANT if match.group("sharpened") else PLAIN_VARIANT,
+        file_name=file_name,
+    )
+
+
+class PageManifest():
+    """
+    SQLite index of the page images in a directory.
+    Written at ingestion time, so finding an assignment's pages is an indexed lookup instead of a directory scan.
+    The modification time of the directory is stored with the index, so an index that no longer matches the
+    files on disk (files added or removed since, or an interrupted write) is detected by is_current.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.directory = os.path.dirname(path)
+        self.connection = sqlite3.connect(path)
+        # Keep the rollback journal in memory: a journal file created and deleted next to the index would
+        # change the directory's modification time on every write. The index can always be rebuilt from the files.
+        self.connection.execute("PRAGMA journal_mode=MEMORY")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                assignment_name TEXT NOT NULL,
+                page_index INTEGER NOT NULL,
+                height TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                PRIMARY KEY (assignment_name, height, variant, page_index)
+            )
+        """)
+        self.connection.commit()
+
+
+    @classmethod
+    def for_directory(cls, directory: str) -> "PageManifest":
+        """
+        Open the manifest stored in a page image directory.
+        """
+        return cls(os.path.join(directory, MANIFEST_FILE))
+
+
+    def add(self, records: Iterable[PageRecord]) -> None:
+        """
+        Add or replace page records.
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO pages (assignment_name, page_index, height, variant, file_name) VALUES (?, ?, ?, ?, ?)",
+            [(record.assignment_name, record.page_index, record.height, record.variant, record.file_name) for record in records],
+        )
+        self.connection.commit()
+
+
+    def add_files(self, file_names: Iterable[str]) -> None:
+        """
+        Add page records parsed from file names, skipping names that are not page images.
+        """
+        records = [parse_page_file_name(file_name) for file_name in file_names]
+        self.add([record for record in records if record is not None])
+
+
+    def remove_files(self, file_names: Iterable[str]) -> None:
+        """
+        Remove the records of the given files.
+        """
+        self.connection.executemany("DELETE FROM pages WHERE file_name = ?", [(file_name,) for file_name in file_names])
+        self.connection.commit()
+
+
+    def directory_generation(self) -> str:
+        return str(os.stat(self.directory or ".").st_mtime_ns)
+
+
+    def is_current(self) -> bool:
+        """
+        Whether the index was last synchronized with the directory as it is now.
+        """
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row is not None and row[0] == self.directory_generation()
+
+
+    def sync(self, file_names: Iterable[str]) -> None:
+        """
+        Make the index match a directory listing: add every page image listed, remove records of files
+        not listed, and record the directory generation the index now matches.
+        """
+        file_names = list(file_names)
+        indexed = [row[0] for row in self.connection.execute("SELECT file_name FROM pages").fetchall()]
+        listed = set(file_names)
+        self.remove_files([file_name for file_name in indexed if file_name not in listed])
+        self.add_files(file_names)
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (self.directory_generation(),))
+        self.connection.commit()
+
+
+    def pages(self, assignment_name: str, height: str, variant: str=PLAIN_VARIANT) -> List[PageRecord]:
+        """
+        Return the pages of an assignment at one height and variant, in page order.
+        Args:
+            assignment_name (str): The assignment name, e.g. E_231_HW_02.
+            height (str): The image height, e.g. "768", or "original" for full resolution.
+            variant (str, optional): "plain" or "sharpened".
+        Returns:
+            List[PageRecord]: The page records.
+        """
+        rows = self.connection.execute(
+            "SELECT assignment_name, page_index, height, variant, file_name FROM pages WHERE assignment_name = ? AND height = ? AND variant = ? ORDER BY page_index",
+            (assignment_name, str(height), variant),
+        ).fetchall()
+        return [PageRecord(assignment_name=row[0], page_index=row[1], height=row[2], variant=row[3], file_name=row[4]) for row in rows]
+
+
+    def assignment_names(self) -> List[str]:
+        rows = self.connection.execute("SELECT DISTINCT assignment_name FROM pages ORDER BY assignment_name").fetchall()
+        return [row[0] for row in rows]
+
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+########
+def index_directory(directory: str) -> PageManifest:
+    """
+    Build or refresh the manifest of an existing page image directory, e.g. one written before manifests existed
+    or one changed since it was indexed.
+    """
+    manifest = PageManifest.for_directory(directory)
+    manifest.sync(sorted(os.listdir(directory)))
+    return manifest
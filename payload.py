@@ -0,0 +1,189 @@
+# Image payloads sent with LLM requests
+
+# Imports
+
+import base64
+import hashlib
+import io
+from PIL import Image, ImageChops, ImageStat
+from typing import List, Tuple
+
+from instrumentation import span
+
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+# Formats tried by encode_for_budget. PNG is sent with a reduced grayscale palette.
+BUDGET_FORMATS = ["JPEG", "WEBP", "PNG"]
+
+
+class ImagePayload():
+    """
+    Encoded image bytes sent with an LLM request.
+    The base64 string and the SHA-256 digest are computed once, on first use, and reused by every request.
+    """
+
+    def __init__(self, image_bytes: bytes, format: str="JPEG"):
+        self.image_bytes = image_bytes
+        self.format = format
+        # Size of the image the payload was encoded from, and the quality used, when re-encoded by encode_for_budget
+        self.source_bytes = len(image_bytes)
+        self.quality: int|None = None
+        self._base64: str|None = None
+        self._sha256: bytes|None = None
+
+
+    @classmethod
+    def from_file(cls, file_path: str, quality: int=100) -> "ImagePayload":
+        """
+        Load a payload from an image file.
+        JPEG files are passed through unchanged. Other formats are decoded and encoded as JPEG.
+        Args:
+            file_path (str): The path to the image file.
+            quality (int, optional): The JPEG quality used when the file has to be re-encoded.
+        Returns:
+            ImagePayload: The payload.
+        """
+        with open(file_path, "rb") as f:
+            image_bytes = f.read()
+        if image_bytes.startswith(JPEG_MAGIC):
+            return cls(image_bytes=image_bytes, format="JPEG")
+        return cls.from_pil_image(Image.open(io.BytesIO(image_bytes)), quality=quality)
+
+
+    @classmethod
+    def from_pil_image(cls, pil_image: Image.Image, format: str="JPEG", quality: int=100) -> "ImagePayload":
+        """
+        Encode a PIL Image into a payload.
+        """
+        if format == "JPEG" and pil_image.mode not in ("L", "RGB", "CMYK"):
+            pil_image = pil_image.convert("RGB")
+        with io.BytesIO() as output:
+            pil_image.save(output, format=format, quality=quality)
+            return cls(image_bytes=output.getvalue(), format=format)
+
+
+    @classmethod
+    def coerce(cls, image: "bytes|ImagePayload") -> "ImagePayload":
+        """
+        Wrap raw JPEG bytes in a payload, returning payloads unchanged.
+        """
+        if isinstance(image, ImagePayload):
+            return image
+        return cls(image_bytes=image, format="JPEG")
+
+
+    @property
+    def base64(self) -> str:
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.image_bytes).decode()
+        return self._base64
+
+
+    @property
+    def sha256(self) -> bytes:
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.image_bytes).digest()
+        return self._sha256
+
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.source_bytes - len(self.image_bytes)
+
+
+    def __len__(self) -> int:
+        return len(self.image_bytes)
+
+
+########
+def _encode(pil_image: Image.Image, format: str, quality: int) -> bytes:
+    with io.BytesIO() as output:
+        if format == "PNG":
+            # quality is the number of gray levels
+            pil_image.quantize(colors=quality, dither=Image.Dither.NONE).save(output, format="PNG", optimize=True)
+        else:
+            pil_image.save(output, format=format, quality=quality)
+        return output.getvalue()
+
+
+def _best_quality(pil_image: Image.Image, format: str, max_bytes: int, qualities: List[int]) -> Tuple[int, bytes]|None:
+    """
+    Highest quality, from an increasing list, whose encoding fits in max_bytes, by binary search. None if none fits.
+    Assumes the size grows with quality, as it does for JPEG and WebP.
+    """
+    best = None
+    low, high = 0, len(qualities) - 1
+    while low <= high:
+        middle = (low + high) // 2
+        image_bytes = _encode(pil_image, format, qualities[middle])
+        if len(image_bytes) <= max_bytes:
+            best = (qualities[middle], image_bytes)
+            low = middle + 1
+        else:
+            high = middle - 1
+    return best
+
+
+def _reconstruction_error(pil_image: Image.Image, image_bytes: bytes) -> float:
+    """
+    Root mean square difference, in gray levels, between a grayscale image and its decoded encoding.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as decoded_image:
+        return ImageStat.Stat(ImageChops.difference(pil_image, decoded_image.convert("L"))).rms[0]
+
+
+def encode_for_budget(pil_image: Image.Image, max_bytes: int, formats: List[str]=BUDGET_FORMATS, min_quality: int=50, max_quality: int=95, min_colors: int=8, max_colors: int=64, source_bytes: int|None=None) -> ImagePayload:
+    """
+    Encode a page in the format and quality that fit a byte budget.
+    Pages are grayscale scans, so they are encoded as grayscale. For each format the highest quality that fits
+    is found (JPEG and WebP quality between min_quality and max_quality, PNG gray levels between min_colors
+    and max_colors). Of those, the one closest to the page once decoded is used, the smaller one if two are
+    equally close, so a budget that fits a high quality JPEG is not spent on a coarser format just because it
+    is smaller. If nothing fits, the smallest encoding tried is used.
+    Args:
+        pil_image (Image): The page image.
+        max_bytes (int): The byte budget.
+        formats (List[str], optional): Formats to try, from JPEG, WEBP and PNG.
+        min_quality, max_quality (int, optional): Range of JPEG and WebP quality.
+        min_colors, max_colors (int, optional): Range of the number of gray levels of PNG.
+        source_bytes (int, optional): Size of the original encoding, to report bytes saved. Defaults to the raw pixel size.
+    Returns:
+        ImagePayload: The payload, with format, quality and source_bytes set.
+    """
+    with span("optimize", width=pil_image.width, height=pil_image.height) as stage:
+        if pil_image.mode != "L":
+            pil_image = pil_image.convert("L")
+
+        candidates = []
+        fallbacks = []
+        for format in formats:
+            if format == "PNG":
+                qualities = [colors for colors in (2, 4, 8, 16, 32, 64, 128, 256) if min_colors <= colors <= max_colors]
+            else:
+                qualities = list(range(min_quality, max_quality + 1, 5))
+            if format == "PNG":
+                # PNG size does not grow steadily with the number of gray levels, so every level is tried, highest first
+                best = None
+                for colors in reversed(qualities):
+                    image_bytes = _encode(pil_image, format, colors)
+                    if len(image_bytes) <= max_bytes:
+                        best = (colors, image_bytes)
+                        break
+            else:
+                best = _best_quality(pil_image, format, max_bytes, qualities)
+            if best is not None:
+                # Errors are rounded to a tenth of a gray level, so near equal fidelity is decided by size
+                error = round(_reconstruction_error(pil_image, best[1]), 1)
+                candidates.append(((error, len(best[1])), format, best[0], best[1]))
+            else:
+                image_bytes = _encode(pil_image, format, qualities[0])
+                fallbacks.append(((len(image_bytes),), format, qualities[0], image_bytes))
+
+        rank, format, quality, image_bytes = min(candidates if len(candidates) > 0 else fallbacks, key=lambda candidate: candidate[0])
+        size = len(image_bytes)
+        payload = ImagePayload(image_bytes=image_bytes, format=format)
+        payload.quality = quality
+        payload.source_bytes = source_bytes if source_bytes is not None else pil_image.width * pil_image.height
+        stage.set(format=format, quality=quality, bytes_in=payload.source_bytes, bytes_out=size, rms_error=rank[0] if len(candidates) > 0 else None)
+    return payload
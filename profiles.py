@@ -0,0 +1,183 @@
+# Row ink projection profiles for finding candidate problem boundaries without the LLM
+#
+# All functions work on a stack of grayscale pages, shape (pages, height, width), so a whole
+# assignment is processed with a handful of NumPy operations. Positions are returned normalized
+# by 1000, the same space Assignment.find_problem_positions uses.
+
+# Imports
+
+import numpy as np
+from PIL import Image
+from typing import Dict, List, Tuple
+
+
+########
+def stack_pages(pil_images: List[Image.Image], height: int=768) -> np.ndarray:
+    """
+    Resize pages to a common height and stack them into one array.
+    Narrower pages are padded with white on the right.
+    Args:
+        pil_images (List[Image]): The page images.
+        height (int, optional): The common page height.
+    Returns:
+        np.ndarray: Grayscale pixels, shape (pages, height, width), dtype uint8.
+    """
+    scaled_images = []
+    for pil_image in pil_images:
+        pil_image = pil_image.convert("L")
+        if pil_image.height != height:
+            pil_image = pil_image.resize((int(pil_image.width * (height / pil_image.height)), height), Image.BILINEAR)
+        scaled_images.append(np.asarray(pil_image))
+
+    width = max(scaled_image.shape[1] for scaled_image in scaled_images)
+    stack = np.full((len(scaled_images), height, width), 255, dtype=np.uint8)
+    for k1, scaled_image in enumerate(scaled_images):
+        stack[k1, :, :scaled_image.shape[1]] = scaled_image
+    return stack
+
+
+def row_ink_profiles(stack: np.ndarray, ink_threshold: int=160, margin_fraction: float=1.0) -> np.ndarray:
+    """
+    Fraction of ink pixels in each row of each page.
+    Args:
+        stack (np.ndarray): Grayscale pages, shape (pages, height, width).
+        ink_threshold (int, optional): Pixels darker than this are ink.
+        margin_fraction (float, optional): Only count the left part of each row, as a fraction of the width.
+    Returns:
+        np.ndarray: Ink fraction per row, shape (pages, height).
+    """
+    width = max(1, int(stack.shape[2] * margin_fraction))
+    return np.count_nonzero(stack[:, :, :width] < ink_threshold, axis=2) / width
+
+
+def _runs(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Runs of True along the last axis of a (pages, height) mask.
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Page index, start row and end row (exclusive) of each run, in page then row order.
+    """
+    padded = np.pad(mask.astype(np.int8), ((0, 0), (1, 1)))
+    edges = np.diff(padded, axis=1)
+    start_pages, starts = np.nonzero(edges == 1)
+    end_pages, ends = np.nonzero(edges == -1)
+    return start_pages, starts, ends
+
+
+def _split_by_page(page_indices: np.ndarray, values: np.ndarray, page_count: int) -> List[np.ndarray]:
+    boundaries = np.searchsorted(page_indices, np.arange(1, page_count))
+    return np.split(values, boundaries)
+
+
+def find_whitespace_gaps(profiles: np.ndarray, blank_fraction: float=0.002, min_gap_rows: int=8) -> List[List[Tuple[int, int]]]:
+    """
+    Blank horizontal bands on each page.
+    Args:
+        profiles (np.ndarray): Row ink profiles, shape (pages, height).
+        blank_fraction (float, optional): Rows with at most this ink fraction are blank.
+        min_gap_rows (int, optional): Minimum height of a gap, in rows.
+    Returns:
+        List[List[Tuple[int, int]]]: For each page, (start, end) of each gap, normalized by 1000.
+    """
+    page_count, height = profiles.shape
+    pages, starts, ends = _runs(profiles <= blank_fraction)
+    keep = (ends - starts) >= min_gap_rows
+    pages, starts, ends = pages[keep], starts[keep], ends[keep]
+
+    normalized = np.stack([starts, ends], axis=1) * 1000 // height
+    return [[(int(start), int(end)) for start, end in page_gaps] for page_gaps in _split_by_page(pages, normalized, page_count)]
+
+
+def find_candidate_starts(stack: np.ndarray, ink_threshold: int=160, blank_fraction: float=0.002, min_gap_rows: int=8, margin_fraction: float=0.15, min_label_rows: int=4) -> List[List[int]]:
+    """
+    Candidate problem start positions on each page.
+    A candidate is the top of an ink blob in the left margin (where problem labels are written)
+    that follows a whitespace gap of at least min_gap_rows across the whole row.
+    Args:
+        stack (np.ndarray): Grayscale pages, shape (pages, height, width).
+        ink_threshold (int, optional): Pixels darker than this are ink.
+        blank_fraction (float, optional): Rows with at most this ink fraction are blank.
+        min_gap_rows (int, optional): Minimum whitespace above a candidate, in rows.
+        margin_fraction (float, optional): Width of the left margin, as a fraction of the page width.
+        min_label_rows (int, optional): Minimum height of a margin blob, in rows, to ignore specks.
+    Returns:
+        List[List[int]]: For each page, candidate start positions normalized by 1000, top to bottom.
+    """
+    page_count, height, width = stack.shape
+    ink = stack < ink_threshold
+
+    margin_width = max(1, int(width * margin_fraction))
+    margin_counts = np.count_nonzero(ink[:, :, :margin_width], axis=2)
+    full_blank = (margin_counts + np.count_nonzero(ink[:, :, margin_width:], axis=2)) <= blank_fraction * width
+    margin_ink = margin_counts > blank_fraction * margin_width
+
+    # Number of non-blank rows in the min_gap_rows rows above each row
+    inked = np.cumsum(~full_blank, axis=1)
+    inked = np.pad(inked, ((0, 0), (min_gap_rows + 1, 0)))
+    inked_above = inked[:, min_gap_rows:-1] - inked[:, :-min_gap_rows - 1]
+
+    pages, starts, ends = _runs(margin_ink)
+    keep = ((ends - starts) >= min_label_rows) & (inked_above[pages, starts] == 0)
+    pages, starts = pages[keep], starts[keep]
+
+    normalized = starts * 1000 // height
+    return [[int(start) for start in page_starts] for page_starts in _split_by_page(pages, normalized, page_count)]
+
+
+########
+def pages_without_candidates(candidates: List[List[int]]) -> List[int]:
+    """
+    Indices of pages with no candidate problem start, which need no LLM request.
+    """
+    return [k1 for k1, page_candidates in enumerate(candidates) if len(page_candidates) == 0]
+
+
+def snap_to_candidates(upper_bounds: Dict[str, int], candidates: List[int], tolerance: int=25) -> Tuple[Dict[str, int], List[str]]:
+    """
+    Move normalized upper bounds to the nearest candidate start.
+    Args:
+        upper_bounds (Dict[str, int]): Normalized upper bounds keyed by problem number, e.g. page.found_problems_normalized.
+        candidates (List[int]): Candidate starts on the same page, normalized by 1000.
+        tolerance (int, optional): Maximum distance to snap, normalized by 1000.
+    Returns:
+        Tuple[Dict[str, int], List[str]]: The snapped upper bounds, and the problem numbers with no
+        candidate within tolerance (outliers), which keep their original bound.
+    """
+    snapped = dict(upper_bounds)
+    outliers = []
+    if len(upper_bounds) == 0:
+        return snapped, outliers
+
+    problem_numbers = list(upper_bounds.keys())
+    bounds = np.array([upper_bounds[problem_number] for problem_number in problem_numbers])
+    if len(candidates) == 0:
+        return snapped, problem_numbers
+
+    candidate_array = np.array(candidates)
+    distances = np.abs(bounds[:, None] - candidate_array[None, :])
+    nearest = distances.argmin(axis=1)
+    for k1, problem_number in enumerate(problem_numbers):
+        if distances[k1, nearest[k1]] <= tolerance:
+            snapped[problem_number] = int(candidate_array[nearest[k1]])
+        else:
+            outliers.append(problem_number)
+    return snapped, outliers
+
+
+def snap_assignment_to_candidates(assignment, candidates: List[List[int]], tolerance: int=25) -> Dict[str, List[str]]:
+    """
+    Snap every page's found problems to the candidate starts of that page, in place.
+    Args:
+        assignment (Assignment): An assignment after find_problem_positions.
+        candidates (List[List[int]]): Candidate starts per page, from find_candidate_starts.
+        tolerance (int, optional): Maximum distance to snap, normalized by 1000.
+    Returns:
+        Dict[str, List[str]]: Outlier problem numbers, keyed by page name, for pages that have any.
+    """
+    outliers = {}
+    for page, page_candidates in zip(assignment.pages, candidates):
+        snapped, page_outliers = snap_to_candidates(page.found_problems_normalized, page_candidates, tolerance=tolerance)
+        page.found_problems_normalized = snapped
+        page.found_problems = {problem_number: int(np.floor(page.image_size[1] / 1000 * upper_bound)) for problem_number, upper_bound in snapped.items()}
+        if len(page_outliers) > 0:
+            outliers[page.page_name] = page_outliers
+    return outliers
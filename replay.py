@@ -0,0 +1,187 @@
+# Record and replay llm_structured responses, to benchmark and regression-test the pipeline offline
+#
+# In record mode every request goes to the provider and its parsed response and latency are saved as a
+# fixture. In replay mode fixtures are served instead, after the recorded (or a simulated) latency, so
+# no provider or credentials are needed. Fixtures are keyed like the response cache (see response_cache_key).
+
+# Imports
+
+import asyncio
+import base64
+import json
+import os
+import random
+import time
+from pydantic import BaseModel
+from typing import Any, Dict, List, Optional, Tuple
+
+import upper_bounds
+from payload import ImagePayload
+from response_cache import response_cache_key
+
+
+DEFAULT_FIXTURE_DIRECTORY = os.path.join("benchmarks", "fixtures", "llm")
+RECORD = "record"
+REPLAY = "replay"
+
+
+class MissingFixtureError(KeyError):
+    """Raised in replay mode for a request that was never recorded."""
+
+
+class ReplayResponse():
+    """Stand-in for an llm_structured response served from a fixture."""
+
+    def __init__(self, structured_response: BaseModel, latency: float):
+        self.structured_response = structured_response
+        self.latency = latency
+        self.replayed = True
+
+
+class ReplayRouter():
+    """
+    Router handed to llm_structured while replay is installed. It remembers the models it was built
+    for, which are part of the fixture key, and wraps the real router in record mode.
+    """
+
+    def __init__(self, models: Tuple[Any, ...], router: Any=None):
+        self.models = models
+        self.router = router
+
+
+########
+def fixture_key(messages: List[Any], model: Any, temperature: Optional[float], response_model: type) -> str:
+    """
+    Key of a request, equal to its response cache key.
+    Args:
+        messages (List): The system message, user prompt message and image message, as built in upper_bounds.
+        model: The model name.
+        temperature (float, optional): The sampling temperature, None if not set.
+        response_model (type): The pydantic response model.
+    Returns:
+        str: The hex digest identifying the request.
+    """
+    system_prompt = messages[0].parts[0].content
+    user_prompt = messages[1].parts[0].content
+    payload = ImagePayload(base64.b64decode(messages[2].parts[0].content))
+    return response_cache_key(image_bytes=payload, system_prompt=system_prompt, user_prompt=user_prompt, model=model, temperature=temperature, response_model=response_model)
+
+
+class ReplayLLM():
+    """
+    Callable with the same signature as llm_structured, recording to or replaying from fixtures.
+    Args:
+        fixture_directory (str, optional): Directory of <key>.json fixtures.
+        mode (str, optional): "record" or "replay".
+        llm (Callable, optional): The provider call used in record mode. Defaults to upper_bounds.llm_structured when installed.
+        get_router (Callable, optional): Builds the provider router in record mode. Defaults to upper_bounds.get_router when installed.
+        latency (float, optional): Simulated seconds per replayed request. Defaults to the recorded latency.
+        latency_scale (float, optional): Factor applied to the replayed latency, 0 replays instantly.
+        latency_jitter (float, optional): Relative jitter of the replayed latency, uniform in +/- this fraction.
+        seed (int, optional): Seed of the latency jitter.
+    """
+
+    def __init__(self, fixture_directory: str=DEFAULT_FIXTURE_DIRECTORY, mode: str=REPLAY, llm: Any=None, get_router: Any=None, latency: float|None=None, latency_scale: float=1.0, latency_jitter: float=0.0, seed: int|None=0):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown mode {mode}, expected {RECORD} or {REPLAY}")
+        self.fixture_directory = fixture_directory
+        self.mode = mode
+        self.llm = llm
+        self.provider_get_router = get_router
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.latency_jitter = latency_jitter
+        self.random = random.Random(seed)
+        self.recorded = 0
+        self.replayed = 0
+        self.missing = 0
+        os.makedirs(self.fixture_directory, exist_ok=True)
+
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.fixture_directory, f"{key}.json")
+
+
+    def get_router(self, models: Tuple[Any, ...]) -> ReplayRouter:
+        # Only build a real router when something will be sent to the provider
+        return ReplayRouter(models=models, router=self.provider_get_router(models) if self.mode == RECORD else None)
+
+
+    async def __call__(self, messages: List[Any], response_model: type, router: ReplayRouter, **kwargs) -> Any:
+
+        model = router.models[0]
+        key = fixture_key(messages, model=model, temperature=kwargs.get("temperature"), response_model=response_model)
+
+        if self.mode == RECORD:
+            start = time.perf_counter()
+            response = await self.llm(messages=messages, response_model=response_model, router=router.router, **kwargs)
+            latency = time.perf_counter() - start
+            self.save(key, model=model, structured_response=response.structured_response, latency=latency)
+            self.recorded += 1
+            return response
+
+        fixture = self.load(key)
+        if fixture is None:
+            self.missing += 1
+            raise MissingFixtureError(f"No fixture for request {key} ({response_model.__name__}) in {self.fixture_directory}")
+
+        latency = (self.latency if self.latency is not None else fixture["latency"]) * self.latency_scale
+        latency *= 1 + self.random.uniform(-self.latency_jitter, self.latency_jitter)
+        if latency > 0:
+            await asyncio.sleep(latency)
+        self.replayed += 1
+        return ReplayResponse(structured_response=response_model.model_validate(fixture["structured_response"]), latency=latency)
+
+
+    def save(self, key: str, model: Any, structured_response: BaseModel, latency: float) -> None:
+        fixture = {
+            "model": str(getattr(model, "value", model)),
+            "response_model": type(structured_response).__name__,
+            "latency": latency,
+            "structured_response": structured_response.model_dump(mode="json"),
+        }
+        path = self._path(key)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(fixture, f, indent=1)
+        os.replace(temporary_path, path)
+
+
+    def load(self, key: str) -> Dict[str, Any]|None:
+        try:
+            with open(self._path(key), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+
+    def stats(self) -> Dict[str, int]:
+        return {"recorded": self.recorded, "replayed": self.replayed, "missing": self.missing}
+
+
+def install_replay(replay: ReplayLLM, module: Any=None) -> Tuple[Any, Any]:
+    """
+    Route llm_structured and get_router in upper_bounds through a ReplayLLM.
+    Args:
+        replay (ReplayLLM): The recorder or replayer.
+        module (optional): The module to patch. Defaults to upper_bounds.
+    Returns:
+        Tuple: The previous llm_structured and get_router, for uninstall_replay.
+    """
+    module = upper_bounds if module is None else module
+    previous = (module.llm_structured, module.get_router)
+    if replay.llm is None:
+        replay.llm = module.llm_structured
+    if replay.provider_get_router is None:
+        replay.provider_get_router = module.get_router
+    module.llm_structured = replay
+    module.get_router = replay.get_router
+    return previous
+
+
+def uninstall_replay(previous: Tuple[Any, Any], module: Any=None) -> None:
+    """
+    Restore what install_replay replaced.
+    """
+    module = upper_bounds if module is None else module
+    module.llm_structured, module.get_router = previous
@@ -0,0 +1,200 @@
+# On-disk cache for structured LLM responses, keyed by a hash of the request
+
+# Imports
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from pydantic import BaseModel
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from payload import ImagePayload
+
+
+DEFAULT_CACHE_DIRECTORY = ".llm_cache"
+
+
+class CachedResponse():
+    """Stand-in for an llm_structured response served from the cache."""
+
+    def __init__(self, structured_response: BaseModel):
+        self.structured_response = structured_response
+        self.cached = True
+
+
+########
+def response_cache_key(image_bytes: bytes|ImagePayload, system_prompt: str, user_prompt: str, model: Any, temperature: Optional[float], response_model: type) -> str:
+    """
+    Build the cache key for a request.
+    Args:
+        image_bytes (bytes | ImagePayload): The image sent with the request.
+        system_prompt (str): The system prompt.
+        user_prompt (str): The user prompt.
+        model: The model name (LLMModelName or str).
+        temperature (float, optional): The sampling temperature, None if not set.
+        response_model (type): The pydantic response model.
+    Returns:
+        str: The hex digest identifying the request.
+    """
+    model_name = getattr(model, "value", model)
+    hasher = hashlib.sha256()
+    hasher.update(ImagePayload.coerce(image_bytes).sha256)
+    for part in (system_prompt, user_prompt, str(model_name), repr(temperature), response_model.__name__, json.dumps(response_model.model_json_schema(), sort_keys=True)):
+        hasher.update(b"\x00")
+        hasher.update(part.encode())
+    return hasher.hexdigest()
+
+
+class ResponseCache():
+    """
+    Persistent cache of parsed structured responses.
+    Entries are evicted least recently used first once the cache exceeds max_bytes,
+    and expire max_age seconds after they were written. Concurrent requests with the
+    same key share a single LLM call.
+    """
+
+    def __init__(self, directory: str=DEFAULT_CACHE_DIRECTORY, max_bytes: int=256 * 1024 * 1024, max_age: Optional[float]=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+        # Entry sizes, least recently used first. The directory is only stat'ed here, at startup
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.listdir(self.directory):
+            if entry.endswith(".json"):
+                stat = os.stat(os.path.join(self.directory, entry))
+                entries.append((stat.st_mtime, entry[:-len(".json")], stat.st_size))
+        self._sizes: OrderedDict[str, int] = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self._total_bytes = sum(self._sizes.values())
+
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+
+    def get(self, key: str, response_model: type) -> Optional[CachedResponse]:
+        """
+        Return the cached response for key, or None if missing or expired.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if self.max_age is not None and time.time() - entry["created"] > self.max_age:
+            self._remove(key)
+            self.expirations += 1
+            return None
+
+        # Touch the entry so eviction is least recently used, here and after a restart
+        os.utime(path)
+        if key in self._sizes:
+            self._sizes.move_to_end(key)
+        return CachedResponse(structured_response=response_model.model_validate(entry["structured_response"]))
+
+
+    def put(self, key: str, structured_response: BaseModel) -> None:
+        """
+        Store a parsed structured response under key.
+        """
+        entry = {
+            "created": time.time(),
+            "response_model": type(structured_response).__name__,
+            "structured_response": structured_response.model_dump(mode="json"),
+        }
+        encoded = json.dumps(entry).encode()
+        path = self._path(key)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(encoded)
+        os.replace(temporary_path, path)
+        self._total_bytes += len(encoded) - self._sizes.pop(key, 0)
+        self._sizes[key] = len(encoded)
+        self._evict()
+
+
+    async def get_or_call(self, key: str, response_model: type, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Return the cached response for key, calling the LLM on a miss.
+        Concurrent calls with the same key wait on the first one instead of calling the LLM again.
+        Args:
+            key (str): The cache key, see response_cache_key.
+            response_model (type): The pydantic response model.
+            call (Callable): Coroutine function making the LLM request.
+        Returns:
+            The cached response, or the LLM response on a miss.
+        """
+        cached_response = self.get(key, response_model)
+        if cached_response is not None:
+            self.hits += 1
+            return cached_response
+
+        if key in self._in_flight:
+            self.coalesced += 1
+            return await asyncio.shield(self._in_flight[key])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            response = await call()
+            self.put(key, response.structured_response)
+            future.set_result(response)
+            return response
+        except BaseException as error:
+            future.set_exception(error)
+            # Mark the exception as retrieved when no one else is waiting on it
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+
+    def _remove(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+        self._total_bytes -= self._sizes.pop(key, 0)
+
+
+    def _evict(self) -> None:
+        # Least recently used first, from the in-memory index
+        while self._total_bytes > self.max_bytes and len(self._sizes) > 0:
+            self._remove(next(iter(self._sizes)))
+            self.evictions += 1
+
+
+    def clear(self) -> None:
+        """
+        Remove every entry from the cache.
+        """
+        for key in list(self._sizes.keys()):
+            self._remove(key)
+
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return hit/miss counters and the current size of the cache.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "entries": len(self._sizes),
+            "bytes": self._total_bytes,
+        }
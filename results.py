@@ -0,0 +1,270 @@
+# Columnar store of detection results, as append-only Parquet part files
+#
+# One row per page and problem identifier of each run, keyed by assignment, page, identifier, model,
+# image variant and run id. Every append writes a new part file, so runs never rewrite earlier results;
+# compact() merges the parts when reload time matters. Every part is written and read with RESULT_SCHEMA,
+# so parts whose columns happen to be all null still load together with the others.
+#
+# Each row has the status of its page: ok, skipped (not sent, e.g. skip_pages) or failed (page.error).
+# Only ok pages count towards miss rates and bound drift.
+
+# Imports
+
+import os
+import re
+import time
+import uuid
+from typing import Any, Dict, List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from assignment import Assignment
+from upper_bounds import DETECTED_SOLUTION_UPPER_BOUNDS_MODEL, NUMBERED_SOLUTION_UPPER_BOUNDS_MODEL
+
+
+DEFAULT_RESULTS_DIRECTORY = "results"
+KEY_COLUMNS = ["assignment_name", "page_index", "identifier", "model", "image_height", "variant", "run_id"]
+
+OK_STATUS = "ok"
+SKIPPED_STATUS = "skipped"
+FAILED_STATUS = "failed"
+
+RESULT_SCHEMA = pa.schema([
+    ("assignment_name", pa.string()),
+    ("course", pa.string()),
+    ("page_index", pa.int64()),
+    ("page_name", pa.string()),
+    ("identifier", pa.string()),
+    ("model", pa.string()),
+    ("image_height", pa.string()),
+    ("variant", pa.string()),
+    ("run_id", pa.string()),
+    ("detection_mode", pa.string()),
+    ("status", pa.string()),
+    ("found", pa.bool_()),
+    ("upper_bound_normalized", pa.int64()),
+    ("upper_bound", pa.int64()),
+    ("error", pa.string()),
+    ("created", pa.float64()),
+])
+
+# Model used by each detection mode of Assignment, when not given to append
+DETECTION_MODE_MODELS = {
+    "numbered": NUMBERED_SOLUTION_UPPER_BOUNDS_MODEL,
+    "combined": DETECTED_SOLUTION_UPPER_BOUNDS_MODEL,
+    "two_step": NUMBERED_SOLUTION_UPPER_BOUNDS_MODEL,
+    "montage": NUMBERED_SOLUTION_UPPER_BOUNDS_MODEL,
+    "adaptive": NUMBERED_SOLUTION_UPPER_BOUNDS_MODEL,
+    "LLMDetector": NUMBERED_SOLUTION_UPPER_BOUNDS_MODEL,
+}
+
+
+########
+def course_name(assignment_name: str) -> str:
+    """
+    The course of an assignment, e.g. MAE_101B for MAE_101B_HW_02.
+    """
+    match = re.match(r"^(?P<course>.+?)_(HW|Exam|Quiz|Lab)_?\d*$", assignment_name, flags=re.IGNORECASE)
+    return match.group("course") if match is not None else assignment_name
+
+
+def page_status(page: Any) -> str:
+    # Error first, a page whose request failed never had its detection_mode set
+    if page.error is not None:
+        return FAILED_STATUS
+    if page.detection_mode is None or page.detection_mode == "skipped":
+        return SKIPPED_STATUS
+    return OK_STATUS
+
+
+def run_model(assignments: List[Assignment]) -> str:
+    """
+    The model of a run: the model of the detection mode used by most of its pages that were sent.
+    Detection modes without a known model (e.g. YOLODetector) are used as the model name.
+    """
+    counts: Dict[str, int] = {}
+    for assignment in assignments:
+        for page in assignment.pages:
+            if page_status(page) != OK_STATUS:
+                continue
+            model = DETECTION_MODE_MODELS.get(page.detection_mode, page.detection_mode)
+            model = str(getattr(model, "value", model))
+            counts[model] = counts.get(model, 0) + 1
+    if len(counts) == 0:
+        return str(NUMBERED_SOLUTION_UPPER_BOUNDS_MODEL.value)
+    return max(counts.keys(), key=lambda model: counts[model])
+
+
+def assignment_rows(assignment: Assignment, run_id: str, model: str) -> List[Dict[str, Any]]:
+    """
+    One row per page and identifier. Every identifier of the assignment gets a row on every page,
+    with found False and upper bounds -1 where it was not found, so misses are rows too.
+    Rows of pages that were skipped or failed are kept, with their status.
+    """
+    created = time.time()
+    model = str(getattr(model, "value", model))
+    identifiers = list(assignment.problem_numbers)
+    for page in assignment.pages:
+        identifiers += [identifier for identifier in page.found_problems_normalized.keys() if identifier not in identifiers]
+
+    rows = []
+    for k1, page in enumerate(assignment.pages):
+        status = page_status(page)
+        for identifier in identifiers:
+            found = identifier in page.found_problems_normalized
+            rows.append({
+                "assignment_name": assignment.assignment_name,
+                "course": course_name(assignment.assignment_name),
+                "page_index": k1,
+                "page_name": page.page_name,
+                "identifier": identifier,
+                "model": model,
+                "image_height": assignment.image_height,
+                "variant": assignment.variant,
+                "run_id": run_id,
+                "detection_mode": page.detection_mode,
+                "status": status,
+                "found": found,
+                "upper_bound_normalized": page.found_problems_normalized[identifier] if found else -1,
+                "upper_bound": page.found_problems.get(identifier, -1),
+                "error": None if page.error is None else repr(page.error),
+                "created": created,
+            })
+    return rows
+
+
+class ResultStore():
+    """
+    Append-only store of detection results in a directory of Parquet part files.
+    """
+
+    def __init__(self, directory: str=DEFAULT_RESULTS_DIRECTORY):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def part_files(self) -> List[str]:
+        return sorted(os.path.join(self.directory, entry) for entry in os.listdir(self.directory) if entry.endswith(".parquet"))
+
+
+    def append(self, assignments: List[Assignment], run_id: str|None=None, model: str|None=None) -> str:
+        """
+        Append the results of assignments after find_problem_positions, as one new part file.
+        Args:
+            assignments (List[Assignment]): The assignments.
+            run_id (str, optional): Identifier of the run. A random one is used if not given.
+            model (str, optional): The model that found the results, recorded once for the run. Defaults to run_model.
+        Returns:
+            str: The run identifier.
+        """
+        run_id = run_id if run_id is not None else uuid.uuid4().hex[:12]
+        model = model if model is not None else run_model(assignments)
+        rows = [row for assignment in assignments for row in assignment_rows(assignment, run_id=run_id, model=model)]
+        if len(rows) == 0:
+            return run_id
+        self._write_part(pa.Table.from_pylist(rows, schema=RESULT_SCHEMA))
+        return run_id
+
+
+    def _write_part(self, table: pa.Table) -> None:
+        path = os.path.join(self.directory, f"part-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.parquet")
+        pq.write_table(table.cast(RESULT_SCHEMA), f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+
+
+    def load(self, columns: List[str]|None=None, run_ids: List[str]|None=None) -> pd.DataFrame:
+        """
+        Load results, optionally only some columns and runs. Filters are pushed down to the Parquet reader,
+        and every part is read as RESULT_SCHEMA.
+        """
+        part_files = self.part_files()
+        if len(part_files) == 0:
+            return RESULT_SCHEMA.empty_table().select(columns if columns is not None else RESULT_SCHEMA.names).to_pandas()
+        filters = [("run_id", "in", run_ids)] if run_ids is not None else None
+        results = pq.read_table(part_files, schema=RESULT_SCHEMA, columns=columns, filters=filters).to_pandas()
+        # Parts written before pages had a status only hold pages that were answered
+        if "status" in results.columns:
+            results["status"] = results["status"].fillna(OK_STATUS)
+        return results
+
+
+    def compact(self) -> int:
+        """
+        Merge every part file into one, for faster reloads. Rows are unchanged.
+        Returns:
+            int: The number of part files merged.
+        """
+        part_files = self.part_files()
+        if len(part_files) <= 1:
+            return len(part_files)
+        self._write_part(pq.read_table(part_files, schema=RESULT_SCHEMA))
+        for part_file in part_files:
+            os.remove(part_file)
+        return len(part_files)
+
+
+    def runs(self) -> pd.DataFrame:
+        """
+        Runs in the store, with their assignments, pages and time, oldest first.
+        """
+        results = self.load(columns=["run_id", "assignment_name", "page_name", "created"])
+        return results.groupby("run_id").agg(
+            assignments=("assignment_name", "nunique"),
+            pages=("page_name", "nunique"),
+            created=("created", "min"),
+        ).sort_values("created").reset_index()
+
+
+    def miss_rates(self, by: List[str]=["course"], run_ids: List[str]|None=None) -> pd.DataFrame:
+        """
+        Fraction of identifiers never found on any page of their assignment.
+        Only pages with status ok count: an identifier is a miss if it was not found on any page that was sent
+        and answered, and assignments without such pages are left out.
+        Args:
+            by (List[str], optional): Columns to group by, e.g. ["course"], ["course", "model"] or ["assignment_name", "run_id"].
+            run_ids (List[str], optional): Only these runs.
+        Returns:
+            DataFrame: Identifiers, misses and miss_rate per group.
+        """
+        results = self.load(columns=list(dict.fromkeys(by + ["assignment_name", "identifier", "model", "image_height", "variant", "run_id", "status", "found"])), run_ids=run_ids)
+        results = results[results["status"] == OK_STATUS]
+        per_identifier = results.groupby(list(dict.fromkeys(by + ["assignment_name", "identifier", "model", "image_height", "variant", "run_id"])), as_index=False)["found"].any()
+        rates = per_identifier.groupby(by).agg(identifiers=("found", "size"), found=("found", "sum")).reset_index()
+        rates["misses"] = rates["identifiers"] - rates["found"]
+        rates["miss_rate"] = rates["misses"] / rates["identifiers"]
+        return rates.drop(columns="found")
+
+
+    def bound_drift(self, run_id: str, baseline_run_id: str) -> pd.DataFrame:
+        """
+        Compare the bounds of two runs, page by page and identifier by identifier.
+        Args:
+            run_id (str): The run to compare.
+            baseline_run_id (str): The run to compare against.
+        Returns:
+            DataFrame: One row per assignment, page and identifier present in either run, with the normalized
+            bound of each run, drift (run minus baseline, for identifiers found in both) and status
+            (same, moved, appeared, disappeared). Only pages with status ok in both runs are compared.
+        """
+        keys = ["assignment_name", "course", "page_index", "identifier", "image_height", "variant"]
+        page_keys = ["assignment_name", "page_index", "image_height", "variant"]
+        results = self.load(columns=keys + ["run_id", "status", "found", "upper_bound_normalized"], run_ids=[run_id, baseline_run_id])
+
+        # Pages answered in both runs
+        answered = results[results["status"] == OK_STATUS].groupby(page_keys)["run_id"].nunique()
+        answered = answered[answered == 2].reset_index()[page_keys]
+        results = results.merge(answered, on=page_keys, how="inner")
+        results = results[results["found"]].drop(columns="status")
+
+        current = results[results["run_id"] == run_id].drop(columns=["run_id", "found"])
+        baseline = results[results["run_id"] == baseline_run_id].drop(columns=["run_id", "found"])
+        drift = current.merge(baseline, on=keys, how="outer", suffixes=("", "_baseline"))
+        drift["drift"] = drift["upper_bound_normalized"] - drift["upper_bound_normalized_baseline"]
+
+        drift["status"] = "moved"
+        drift.loc[drift["drift"] == 0, "status"] = "same"
+        drift.loc[drift["upper_bound_normalized_baseline"].isna(), "status"] = "appeared"
+        drift.loc[drift["upper_bound_normalized"].isna(), "status"] = "disappeared"
+        return drift.sort_values(keys).reset_index(drop=True)
@@ -0,0 +1,212 @@
+# Rate limiting, deadlines, retries and hedged requests for LLM calls
+
+# Imports
+
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, TypeVar
+
+
+T = TypeVar("T")
+
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+TRANSIENT_MESSAGES = ("429", "rate limit", "resource exhausted", "overloaded", "unavailable", "timeout", "timed out", "deadline")
+
+# Rough token counts, used only to pace requests against a tokens per minute limit
+IMAGE_TOKENS = 258
+RESPONSE_TOKENS = 256
+
+
+########
+def estimate_request_tokens(system_prompt: str, user_prompt: str, image_count: int=1) -> int:
+    """
+    Rough number of tokens a request will use, about four characters per text token.
+    """
+    return (len(system_prompt) + len(user_prompt)) // 4 + image_count * IMAGE_TOKENS + RESPONSE_TOKENS
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Whether an error is worth retrying: timeouts, connection errors, rate limits and server errors.
+    """
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    for attribute in ("status_code", "status", "code"):
+        status = getattr(error, attribute, None)
+        if isinstance(status, int):
+            return status in TRANSIENT_STATUS_CODES
+    message = str(error).lower()
+    return any(transient_message in message for transient_message in TRANSIENT_MESSAGES)
+
+
+class TokenBucket():
+    """
+    Token bucket refilled continuously at rate_per_minute, holding at most capacity tokens.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float|None=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_minute / 60.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float=1.0) -> float:
+        """
+        Wait until amount tokens are available and take them.
+        Requests larger than the capacity wait for a full bucket and take all of it.
+        Returns:
+            float: Seconds spent waiting, including waiting for other callers ahead in line.
+        """
+        amount = min(amount, self.capacity)
+        start = time.monotonic()
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+        return time.monotonic() - start
+
+
+class LLMScheduler():
+    """
+    Runs LLM calls under a requests and tokens per minute limit, with a deadline per call,
+    jittered exponential backoff on transient errors, and optional hedged requests.
+    A hedged request is a duplicate started when the first attempt has been running longer
+    than the hedge quantile (p95 by default) of recent latencies; the first to finish wins.
+    Only the last latency_window latencies are kept, so hedging follows recent latency in a long-lived worker.
+    """
+
+    def __init__(self, requests_per_minute: float=60, tokens_per_minute: float|None=None, timeout: float=60.0, deadline: float=300.0, max_retries: int=4, backoff_base: float=1.0, backoff_max: float=30.0, hedge: bool=False, hedge_quantile: float=0.95, hedge_min_samples: int=20, latency_window: int=500, seed: int|None=None):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute, capacity=tokens_per_minute / 6) if tokens_per_minute is not None else None
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.random = random.Random(seed)
+
+        self.latencies: Deque[float] = deque(maxlen=latency_window)
+        self.counters = {"calls": 0, "attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "timeouts": 0, "failures": 0}
+        self.throttled_seconds = 0.0
+
+
+    def hedge_delay(self) -> float|None:
+        """
+        Seconds after which to start a hedged request, or None if hedging is off or there are too few samples.
+        """
+        if not self.hedge or len(self.latencies) < self.hedge_min_samples:
+            return None
+        recent = sorted(self.latencies)
+        return recent[min(len(recent) - 1, int(self.hedge_quantile * len(recent)))]
+
+
+    def backoff(self, retry: int) -> float:
+        # Full jitter: uniform between zero and the exponential backoff
+        return self.random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+
+
+    async def _throttle(self, estimated_tokens: int) -> None:
+        # Counted from entry, so waits cut short by the deadline are included
+        start = time.monotonic()
+        try:
+            await self.request_bucket.acquire(1)
+            if self.token_bucket is not None and estimated_tokens > 0:
+                await self.token_bucket.acquire(estimated_tokens)
+        finally:
+            self.throttled_seconds += time.monotonic() - start
+
+
+    async def _attempt(self, call: Callable[[], Awaitable[T]], estimated_tokens: int, timeout: float, deadline_at: float) -> T:
+        # Waiting for the rate limit counts against the deadline of the call
+        await asyncio.wait_for(self._throttle(estimated_tokens), timeout=max(deadline_at - time.monotonic(), 0.001))
+        self.counters["attempts"] += 1
+        start = time.monotonic()
+        result = await asyncio.wait_for(call(), timeout=min(timeout, max(deadline_at - start, 0.001)))
+        self.latencies.append(time.monotonic() - start)
+        return result
+
+
+    async def _hedged_attempt(self, call: Callable[[], Awaitable[T]], estimated_tokens: int, timeout: float, deadline_at: float) -> T:
+
+        hedge_delay = self.hedge_delay()
+        if hedge_delay is None or hedge_delay >= timeout:
+            return await self._attempt(call, estimated_tokens, timeout, deadline_at)
+
+        primary = asyncio.ensure_future(self._attempt(call, estimated_tokens, timeout, deadline_at))
+        done, pending = await asyncio.wait({primary}, timeout=hedge_delay)
+        if primary in done:
+            return primary.result()
+
+        self.counters["hedges"] += 1
+        secondary = asyncio.ensure_future(self._attempt(call, estimated_tokens, timeout - hedge_delay, deadline_at))
+        attempts = {primary, secondary}
+        error: BaseException|None = None
+        try:
+            while len(attempts) > 0:
+                done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is secondary:
+                            self.counters["hedge_wins"] += 1
+                        return attempt.result()
+                    error = attempt.exception()
+            raise error
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+
+    async def call(self, call: Callable[[], Awaitable[T]], estimated_tokens: int=0) -> T:
+        """
+        Run an LLM call under the scheduler.
+        Args:
+            call (Callable): Coroutine function making one request. It is called again for each retry or hedge.
+            estimated_tokens (int, optional): Tokens the request is expected to use, see estimate_request_tokens.
+        Returns:
+            The result of the first successful attempt.
+        Raises:
+            The last error, if it is not transient, retries are exhausted or the deadline has passed.
+            The deadline covers waiting for the rate limit, attempts and backoff.
+        """
+        self.counters["calls"] += 1
+        start = time.monotonic()
+        retry = 0
+        while True:
+            remaining = self.deadline - (time.monotonic() - start)
+            try:
+                return await self._hedged_attempt(call, estimated_tokens, timeout=min(self.timeout, max(remaining, 0.001)), deadline_at=start + self.deadline)
+            except Exception as error:
+                if isinstance(error, asyncio.TimeoutError):
+                    self.counters["timeouts"] += 1
+                delay = self.backoff(retry)
+                remaining = self.deadline - (time.monotonic() - start)
+                if not is_transient_error(error) or retry >= self.max_retries or delay >= remaining:
+                    self.counters["failures"] += 1
+                    raise
+                retry += 1
+                self.counters["retries"] += 1
+                await asyncio.sleep(delay)
+
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return call counters and percentiles of recent latencies in seconds.
+        """
+        recent = sorted(self.latencies)
+        percentiles = {}
+        for name, quantile in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+            percentiles[name] = recent[min(len(recent) - 1, int(quantile * len(recent)))] if len(recent) > 0 else None
+        return {**self.counters, **percentiles, "throttled_seconds": self.throttled_seconds}
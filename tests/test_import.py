@@ -0,0 +1,20 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from bench_import import LAZY_MODULES, MODULES, measure
+
+
+IMPORT_BUDGET_SECONDS = 1.0
+
+
+def test_cold_import_is_within_budget():
+    # Best of three fresh interpreters, so a busy machine does not fail the test
+    measurements = [measure(MODULES) for k1 in range(3)]
+    assert min(measurement["seconds"] for measurement in measurements) <= IMPORT_BUDGET_SECONDS
+
+
+def test_heavy_modules_are_imported_lazily():
+    loaded = set(measure(MODULES)["modules"])
+    assert [name for name in LAZY_MODULES if name in loaded] == []
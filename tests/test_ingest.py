@@ -0,0 +1,27 @@
+import os
+import shutil
+
+import pytest
+
+import instrumentation
+from ingest import ingest
+
+
+PDF_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pdf")
+
+requires_poppler = pytest.mark.skipif(shutil.which("pdftoppm") is None, reason="poppler is not installed")
+
+
+@requires_poppler
+def test_ingest_merges_worker_spans(tmp_path):
+    instrumentation.enable()
+    try:
+        report = ingest({"E_231_HW_02": [0, 1]}, input_directory=PDF_DIRECTORY, output_directory=str(tmp_path), heights=[640], workers=2)
+        records = instrumentation.records()
+    finally:
+        instrumentation.disable()
+
+    assert report.failed == {}
+    assert {"rasterize", "resize", "sharpen", "encode", "write"} <= {record["stage"] for record in records}
+    assert {record["page"] for record in records if record["stage"] == "rasterize"} == {"E_231_HW_02_00", "E_231_HW_02_01"}
+    assert {record["assignment"] for record in records} == {"E_231_HW_02"}
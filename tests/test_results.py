@@ -0,0 +1,70 @@
+import asyncio
+
+from PIL import Image
+
+from assignment import Assignment
+from fake_llm import FakeLLM, FakeProviderError, install_fake_llm
+from results import FAILED_STATUS, OK_STATUS, SKIPPED_STATUS, ResultStore
+from upper_bounds import NumberedSolutionUpperBound, NumberedSolutionUpperBounds
+
+
+def make_assignment(directory, found_problems, failed=(), skipped=()):
+    # Each page has its own shade, so the fake LLM can tell the pages apart by their image
+    for k1 in range(len(found_problems)):
+        Image.new("L", (100, 200), 255 - k1).save(directory / f"A_HW_01_{k1:02d}_768.jpg")
+    assignment = Assignment("A_HW_01", str(directory), ["1", "2", "3", "4", "5"])
+    page_indices = {page.payload.base64: k1 for k1, page in enumerate(assignment.pages)}
+
+    def handler(messages, response_model):
+        k1 = page_indices[messages[2].parts[0].content]
+        if k1 in failed:
+            raise FakeProviderError(status_code=500, message="timeout")
+        return NumberedSolutionUpperBounds(upper_bounds=[NumberedSolutionUpperBound(solution_number=identifier, upper_bound=found_problems[k1].get(identifier, -1)) for identifier in assignment.problem_numbers])
+
+    previous = install_fake_llm(FakeLLM(handler))
+    try:
+        asyncio.run(assignment.find_problem_positions(skip_pages=list(skipped)))
+    finally:
+        install_fake_llm(previous)
+    return assignment
+
+
+def test_load_runs_with_and_without_errors(tmp_path):
+    (tmp_path / "jpg").mkdir()
+    store = ResultStore(str(tmp_path / "results"))
+    clean = make_assignment(tmp_path / "jpg", [{"1": 100, "2": 500}, {"3": 0, "4": 300, "5": 800}])
+    store.append([clean], run_id="clean")
+    failed = make_assignment(tmp_path / "jpg", [{"1": 100, "2": 500}, {}], failed=[1])
+    store.append([failed], run_id="failed")
+
+    results = store.load()
+    assert set(results["run_id"]) == {"clean", "failed"}
+    assert set(results[results["run_id"] == "failed"]["status"]) == {OK_STATUS, FAILED_STATUS}
+    assert results[results["status"] == FAILED_STATUS]["error"].str.contains("timeout").all()
+
+    store.compact()
+    assert len(store.load()) == len(results)
+
+
+def test_skipped_and_failed_pages_are_not_misses(tmp_path):
+    (tmp_path / "jpg").mkdir()
+    store = ResultStore(str(tmp_path / "results"))
+    found_problems = [{}, {"1": 100, "2": 500}, {"3": 0, "4": 300}, {}, {}]
+    assignment = make_assignment(tmp_path / "jpg", found_problems, failed=[3], skipped=[0])
+    store.append([assignment], run_id="run")
+
+    results = store.load(columns=["model", "status"])
+    assert results["model"].nunique() == 1
+    assert (results["status"] == SKIPPED_STATUS).sum() == 5
+    assert (results["status"] == FAILED_STATUS).sum() == 5
+
+    miss_rates = store.miss_rates(by=["course"])
+    assert miss_rates["identifiers"].tolist() == [5]
+    assert miss_rates["miss_rate"].tolist() == [0.2]
+
+    # Problems 3 and 4 are on a page that failed in the baseline, so they are not compared
+    baseline = make_assignment(tmp_path / "jpg", found_problems, failed=[2, 3], skipped=[0])
+    store.append([baseline], run_id="baseline")
+    drift = store.bound_drift("run", "baseline")
+    assert drift["identifier"].tolist() == ["1", "2"]
+    assert set(drift["status"]) == {"same"}
@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+import pytest
+from pydantic import BaseModel
+
+from fake_llm import FakeLLM, FakeProviderError
+from scheduler import LLMScheduler
+
+
+class Answer(BaseModel):
+    value: int = 1
+
+
+def run_calls(scheduler, fake, count):
+
+    async def one():
+        return await scheduler.call(lambda: fake([], Answer))
+
+    async def main():
+        return await asyncio.gather(*[one() for k1 in range(count)], return_exceptions=True)
+
+    return asyncio.run(main())
+
+
+def test_transient_errors_are_retried():
+    fake = FakeLLM(lambda messages, response_model: Answer(), error_rate=0.3, seed=1)
+    scheduler = LLMScheduler(requests_per_minute=60000, max_retries=8, backoff_base=0.001, backoff_max=0.01, seed=1)
+    results = run_calls(scheduler, fake, 50)
+
+    assert all(not isinstance(result, BaseException) for result in results)
+    assert fake.errors > 0
+    assert scheduler.stats()["retries"] == fake.errors
+
+
+def test_permanent_errors_are_not_retried():
+    fake = FakeLLM(lambda messages, response_model: Answer(), error_rate=1.0, error_status_codes=[400], seed=1)
+    scheduler = LLMScheduler(requests_per_minute=60000, backoff_base=0.001, seed=1)
+    results = run_calls(scheduler, fake, 3)
+
+    assert all(isinstance(result, FakeProviderError) for result in results)
+    assert fake.calls == 3
+
+
+def test_deadline_covers_rate_limit_wait():
+    fake = FakeLLM(lambda messages, response_model: Answer())
+    scheduler = LLMScheduler(requests_per_minute=60, deadline=1.5)
+    start = time.monotonic()
+    results = run_calls(scheduler, fake, 5)
+
+    assert time.monotonic() - start < 2.0
+    assert sum(1 for result in results if isinstance(result, asyncio.TimeoutError)) == 3
+    assert fake.calls == 2
+    # Every caller's wait is counted, not only the sleep of the one holding the bucket
+    assert scheduler.stats()["throttled_seconds"] == pytest.approx(1.0 + 3 * 1.5, abs=0.2)
+
+
+def test_hedged_requests_cut_tail_latency():
+    fake = FakeLLM(lambda messages, response_model: Answer(), latency=0.01, tail_rate=0.03, tail_latency=1.0, seed=3)
+    scheduler = LLMScheduler(requests_per_minute=60000, hedge=True, hedge_min_samples=20, seed=3)
+
+    async def main():
+        # Calls one at a time, so the latency of each call is its own
+        for k1 in range(100):
+            await scheduler.call(lambda: fake([], Answer))
+
+    start = time.monotonic()
+    asyncio.run(main())
+
+    stats = scheduler.stats()
+    assert stats["hedges"] > 0
+    assert stats["hedge_wins"] > 0
+    # Without hedging, the slow calls alone would take about a second each
+    assert time.monotonic() - start < 1.0 + stats["hedges"] * 0.2
@@ -1,10 +1,9 @@
 #
 
-import base64
+import functools
 from pydantic import BaseModel
-from typing import  List
+from typing import  Any, List
 
-from library.opensource.aikernel import LLMModelName
 from library.opensource.aikernel import (
     LLMMessageContentType,
     LLMMessagePart,
@@ -15,6 +14,23 @@ from library.opensource.aikernel import (
     llm_structured
 )
 
+from instrumentation import span
+from payload import ImagePayload
+from response_cache import ResponseCache, response_cache_key
+from scheduler import LLMScheduler, estimate_request_tokens
+
+
+SOLUTION_NUMBERS_MODEL = LLMModelName.GEMINI_20_FLASH
+SOLUTION_UPPER_BOUNDS_MODEL = LLMModelName.GEMINI_20_FLASH
+NUMBERED_SOLUTION_UPPER_BOUNDS_MODEL = LLMModelName.GEMINI_25_FLASH
+DETECTED_SOLUTION_UPPER_BOUNDS_MODEL = LLMModelName.GEMINI_25_FLASH
+
+# Image formats the LLM accepts, by payload format. encode_for_budget should only be given these
+IMAGE_CONTENT_TYPES = {format: LLMMessageContentType[format] for format in ("JPEG", "WEBP", "PNG") if format in LLMMessageContentType.__members__}
+SUPPORTED_IMAGE_FORMATS = list(IMAGE_CONTENT_TYPES.keys())
+
+# Scheduler shared by every request, see set_scheduler
+llm_scheduler: LLMScheduler|None = None
 
 
 class SolutionNumbers(BaseModel):
@@ -33,26 +49,153 @@ class NumberedSolutionUpperBounds(BaseModel):
     """Upper bounds for solutions to problems or subproblems."""
     upper_bounds: List[NumberedSolutionUpperBound]
 
-async def get_solution_numbers(image_bytes: bytes, example_image_bytes: bytes|None=None):
+class DetectedSolutionUpperBounds(BaseModel):
+    """Problem numbers found in the image with the upper bound of each, from top to bottom."""
+    upper_bounds: List[NumberedSolutionUpperBound]
+
+
+def validate_numbered_solution_upper_bounds(upper_bounds: List[NumberedSolutionUpperBound], solution_numbers: List[str]|None=None, allow_missing: bool=True) -> List[str]:
+    """
+    Check that upper bounds are usable.
+    Bounds must be in the normalized range 0-1000 (or -1 if allow_missing), and bounds that were found
+    must increase in the order listed, with identifiers non-empty and unique.
+    Args:
+        upper_bounds (List[NumberedSolutionUpperBound]): The upper bounds returned by the LLM.
+        solution_numbers (List[str], optional): The identifiers that were requested, if any, in order.
+        allow_missing (bool, optional): Whether -1 (not found) is accepted.
+    Returns:
+        List[str]: Descriptions of the problems found, empty if the upper bounds are valid.
+    """
+    problems = []
+
+    identifiers = [upper_bound.solution_number.strip() for upper_bound in upper_bounds]
+    if any(identifier == "" for identifier in identifiers):
+        problems.append("empty identifier")
+    if len(set(identifiers)) != len(identifiers):
+        problems.append("duplicate identifiers")
+    if solution_numbers is not None and len(upper_bounds) != len(solution_numbers):
+        problems.append(f"expected {len(solution_numbers)} upper bounds, got {len(upper_bounds)}")
+
+    found = []
+    for upper_bound in upper_bounds:
+        if upper_bound.upper_bound == -1:
+            if not allow_missing:
+                problems.append(f"missing upper bound for {upper_bound.solution_number}")
+        elif upper_bound.upper_bound < 0 or upper_bound.upper_bound > 1000:
+            problems.append(f"upper bound {upper_bound.upper_bound} for {upper_bound.solution_number} out of range")
+        else:
+            found.append(upper_bound.upper_bound)
+    if any(found[k1] > found[k1 + 1] for k1 in range(len(found) - 1)):
+        problems.append("upper bounds not sorted")
+
+    return problems
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_router(get_router_function: Any, models: tuple) -> Any:
+    return get_router_function(models=models)
+
+
+def router_for(model: LLMModelName) -> Any:
+    """
+    The router for a model, built once and reused by every request.
+    Keyed on get_router too, so routers built before install_fake_llm or install_replay patch it are not reused.
+    """
+    return _cached_router(get_router, (model,))
+
+
+def set_scheduler(new_scheduler: LLMScheduler|None) -> LLMScheduler|None:
+    """
+    Run every LLM request through a scheduler (rate limits, deadlines, retries and hedging), or None to call directly.
+    Returns:
+        LLMScheduler: The previous scheduler, so it can be restored.
+    """
+    global llm_scheduler
+    previous = llm_scheduler
+    llm_scheduler = new_scheduler
+    return previous
+
+
+async def _llm_structured_image(image_bytes: bytes|ImagePayload, system_prompt: str, user_prompt: str, model: LLMModelName, response_model: type, temperature: float|None=None, cache: ResponseCache|None=None) -> Any:
+    """
+    Send a system prompt, user prompt and image to the LLM and parse the structured response.
+    If a cache is given, identical requests are served from it instead of calling the LLM.
+    The image is sent as given, either raw JPEG bytes or an ImagePayload whose base64 encoding is reused across calls.
+    The content type is the LLMMessageContentType named like the payload format, see IMAGE_CONTENT_TYPES.
+    If a scheduler is set, cache misses are sent through it.
+    """
+    payload = ImagePayload.coerce(image_bytes)
+    if payload.format not in IMAGE_CONTENT_TYPES:
+        raise ValueError(f"Image format {payload.format} is not supported by the LLM, expected one of {SUPPORTED_IMAGE_FORMATS}")
+
+    async def request() -> Any:
+        # Only pass temperature when set, so the router default applies otherwise
+        options = {} if temperature is None else {"temperature": temperature}
+        with span("base64", bytes_in=len(payload)) as stage:
+            image_base64 = payload.base64
+            stage.set(bytes_out=len(image_base64))
+        # Latency includes parsing the structured response, which happens inside llm_structured
+        with span("llm", model=str(getattr(model, "value", model)), response_model=response_model.__name__, bytes_in=len(payload)):
+            return await llm_structured(
+                messages=[
+                    LLMSystemMessage(
+                        parts=[
+                            LLMMessagePart(
+                                content_type=LLMMessageContentType.TEXT,
+                                content=system_prompt,
+                            )
+                        ]
+                    ),
+                    LLMUserMessage(
+                        parts=[
+                            LLMMessagePart(
+                                content_type=LLMMessageContentType.TEXT,
+                                content=user_prompt,
+                            )
+                        ]
+                    ),
+                    LLMUserMessage(
+                        parts=[
+                            LLMMessagePart(
+                                content_type=IMAGE_CONTENT_TYPES[payload.format],
+                                content=image_base64
+                            ),
+                        ]
+                    ),
+                ],
+                router=router_for(model),
+                response_model=response_model,
+                **options,
+            )
+
+    async def call() -> Any:
+        if llm_scheduler is None:
+            return await request()
+        return await llm_scheduler.call(request, estimated_tokens=estimate_request_tokens(system_prompt, user_prompt))
+
+    if cache is None:
+        return await call()
+
+    key = response_cache_key(
+        image_bytes=payload,
+        system_prompt=system_prompt,
+        user_prompt=user_prompt,
+        model=model,
+        temperature=temperature,
+        response_model=response_model,
+    )
+    return await cache.get_or_call(key=key, response_model=response_model, call=call)
 
-    solution_numbers = await llm_structured(
-        messages=[
-            LLMSystemMessage(
-            parts=[
-                LLMMessagePart(
-                    content_type=LLMMessageContentType.TEXT,
-                    content=f"""
+
+async def get_solution_numbers(image_bytes: bytes|ImagePayload, example_image_bytes: bytes|None=None, cache: ResponseCache|None=None):
+
+    # Detect the number denoting each problem. If a problem has multiple parts, detect the letters or number and letter denoting each subproblem in the image.
+    solution_numbers = await _llm_structured_image(
+        image_bytes=image_bytes,
+        system_prompt=f"""
                     Return the number of the problems or subproblems in the image as an array of strings.
                     """,
-                )
-            ]
-        ),
-        # Detect the number denoting each problem. If a problem has multiple parts, detect the letters or number and letter denoting each subproblem in the image.
-        LLMUserMessage(
-            parts=[
-                LLMMessagePart(
-                    content_type=LLMMessageContentType.TEXT,
-                    content=f"""
+        user_prompt=f"""
                     Detect the marking denoting each problem or problem part in the image of an assignment.
                     Markings are usually a number or letter, and are typically found to the left near the top of the the problem or problem part.
                     Problems are typically denoted by a number, sometimes with a period or parenthesis (for example, "1", "2.", "3)")
@@ -60,46 +203,59 @@ async def get_solution_numbers(image_bytes: bytes, example_image_bytes: bytes|No
                     Problem parts may also be denoted by a number and letter (for example, "1a", "1b", "1c", "2a", "2b")
                     Return the numbers for problems, and combination of number and letter for subproblems (e.g., "1a", "1b", "2", "3a", "3b", "3c").
                     """,
-                )
-            ]
-        ),
-        LLMUserMessage(
-            parts=[
-                LLMMessagePart(
-                    content_type=LLMMessageContentType.JPEG,
-                    content=base64.b64encode(image_bytes).decode()
-                ),
-            ]
-        ),
-        ],
-        # model="gemini-2.0-flash-001",
-        router=get_router(models=(LLMModelName.GEMINI_20_FLASH,)),
-        # router=get_router(models=("gemini-2.0-flash-001")),
-        response_model=SolutionNumbers
+        model=SOLUTION_NUMBERS_MODEL,
+        response_model=SolutionNumbers,
+        cache=cache,
     )
     
     return solution_numbers
 
 
-async def get_solution_upper_bounds(image_bytes: bytes, example_image_bytes: bytes|None=None):
+async def get_detected_solution_upper_bounds(image_bytes: bytes|ImagePayload, cache: ResponseCache|None=None):
+
+    # Problem numbers and upper bounds in one request, for assignments whose problem numbers are not known
+    detected_solution_upper_bounds = await _llm_structured_image(
+        image_bytes=image_bytes,
+        system_prompt=f"""
+    Return the number of each problem in the image and the y-axis position of the upper bound of that problem, normalized by 1000.
+    """,
+        user_prompt=f"""
+    Detect each problem in the provided image of an assignment, and the y-coordinate of the upper boundary of each problem, including the problem statement.
+
+    TASK DEFINITION:
+    - Detect the marking denoting each problem or problem part. Markings are usually a number or letter, and are typically found to the left near the top of the problem or problem part.
+    - For each problem, identify the upper boundary of the entire problem, including the problem statement.
+    - Return the y-coordinate value for this upper boundary, normalized so the top of the image is 0 and the bottom is 1000.
 
-    solution_upper_bounds = await llm_structured(
-        messages=[
-            LLMSystemMessage(
-                parts=[
-                    LLMMessagePart(
-                        content_type=LLMMessageContentType.TEXT,
-                        content=f"""
+    PROBLEM NUMBERING CONVENTIONS:
+    - Problems are typically denoted by a number, sometimes with a period or parenthesis (e.g., "1", "2.", "3)", "4.5")
+    - Problem parts are typically denoted by a letter, or a number and letter (e.g., "a", "b.", "1a", "2b")
+    - Return the numbers for problems, and combination of number and letter for subproblems (e.g., "1a", "1b", "2", "3a").
+
+    OUTPUT FORMAT:
+    - List the problems from the top of the image to the bottom, so the upper bounds increase.
+    - Only list problems present in the image.
+
+    HANDLING EDGE CASES:
+    - Numbers inside a problem statement or solution (steps, matrix indices, references to other problems) are not problem markings.
+    - If problem boundaries are unclear, use visual cues such as whitespace, horizontal lines, or changes in formatting to determine boundaries.
+    """,
+        model=DETECTED_SOLUTION_UPPER_BOUNDS_MODEL,
+        response_model=DetectedSolutionUpperBounds,
+        cache=cache,
+    )
+
+    return detected_solution_upper_bounds
+
+
+async def get_solution_upper_bounds(image_bytes: bytes|ImagePayload, example_image_bytes: bytes|None=None, cache: ResponseCache|None=None):
+
+    solution_upper_bounds = await _llm_structured_image(
+        image_bytes=image_bytes,
+        system_prompt=f"""
                         Return the y-axis positions at the top of each problem or subproblem solutions as an array of integers. Never return masks.
                         """,
-                    )
-                ]
-            ),
-            LLMUserMessage(
-                parts=[
-                    LLMMessagePart(
-                        content_type=LLMMessageContentType.TEXT,
-                        content=f"""
+        user_prompt=f"""
                         Detect the upper bound of each of the solutions to the problems or subproblems in the image.
                         Include the problem statement and/or prompt when calculating the upper bounds.
                         If a problem has multiple parts (e.g., 1a, 1b, 1c), treat each part as a separate problem, and return the upper bound for each part.
@@ -107,118 +263,85 @@ async def get_solution_upper_bounds(image_bytes: bytes, example_image_bytes: byt
                         Subproblems are typically denoted by a letter, sometimes with a period or parenthesis (e.g., "a", "b.", "c)")
                         The upper bounds are the y-axis positions at the top of each problem or subproblem solutions.
                         """,
-                    )
-                ]
-            ),
-            LLMUserMessage(
-                parts=[
-                    LLMMessagePart(
-                        content_type=LLMMessageContentType.JPEG,
-                        content=base64.b64encode(image_bytes).decode()
-                    ),
-                ]
-            ),
-        ],
-        # router=get_router(models=("gemini-2.0-flash-001")),
-        router=get_router(models=(LLMModelName.GEMINI_20_FLASH,)),
+        model=SOLUTION_UPPER_BOUNDS_MODEL,
         temperature=0.0,
-        response_model=SolutionUpperBounds
+        response_model=SolutionUpperBounds,
+        cache=cache,
     )
     
     return solution_upper_bounds
 
         
-async def get_numbered_solution_upper_bounds(image_bytes: bytes, system_prompt:str, user_prompt: str, solution_numbers: List[str], example_image_bytes: bytes|None=None):
-
-    solution_upper_bounds = await llm_structured(
-        messages=[
-            LLMSystemMessage(
-            parts=[
-                LLMMessagePart(
-                    content_type=LLMMessageContentType.TEXT,
-                    content=system_prompt
-                    # f"""
-                    # Return the y-axis positions at the top of each problem or subproblem solutions. Never return masks.
-                    # """,
-                )
-            ]
-        ),
-        LLMUserMessage(
-            parts=[
-                LLMMessagePart(
-                    content_type=LLMMessageContentType.TEXT,
-                    # content=f"""
-                    # Detect the upper bound of solutions to the problems or subproblems in the image for the provided problem numbers.
-                    # Include the problem statement and/or prompt when calculating the upper bounds.
-                    # If a problem has multiple parts (e.g., 1a, 1b, 1c), treat each part as a separate problem, and return the upper bound for each part.
-                    # Problems are typically denoted by a number, sometimes with a period or parenthesis (e.g., "1", "2.", "3)")
-                    # Subproblems are typically denoted by a letter, sometimes with a period or parenthesis (e.g., "a", "b.", "c)")
-                    # The upper bounds are the y-axis positions at the top of each problem or subproblem solutions.
-                    # If you cannot detect the upper bound for a problem or subproblem, return -1.
-                    # The problem numbers are {[f"{k1}" for k1 in solution_numbers]}.
-                    # Return a dictionary with the problem numbers as keys and the upper bounds as values.
-                    # The dictionary should be in the format {{ "1": 100, "2a": 200, "2b": 300, "2c": -1, "3": 400 }}.
-                    # """,
-                    # content=f"""
-                    # Detect the upper boundary y-coordinate of solutions to problems in the provided image.
-
-                    # TASK DEFINITION:
-                    # - For each problem identifier provided in the input list, identify where the solution area begins (upper boundary).
-                    # - Return the y-coordinate value (in pixels from the top of the image) for this upper boundary.
-                    # - The y-coordinate represents the vertical position where the solution to the current problem begins.
-
-                    # PROBLEM NUMBERING CONVENTIONS:
-                    # - Problem identifiers are provided as strings in the solution_numbers list.
-                    # - These identifiers represent main problems (e.g., "1", "2.", "3)", "4.5")
-
-                    # OUTPUT FORMAT:
-                    # - Use -1 for any problem whose boundary cannot be confidently determined, or if the problem is not present in the image.
-
-                    # HANDLING EDGE CASES:
-                    # - If problem boundaries are unclear or solutions overlap, use visual cues such as whitespace, horizontal lines, or changes in formatting to determine boundaries.
-                    # - If multiple possible boundaries exist, choose the most visually distinct one.
-
-                    # The problem identifiers to detect are: {solution_numbers}
-                    # """
-                    # content=f"""
-                    # Detect the y-coordinate of the upper boundary problems in the provided image, including the problem statement.
-
-                    # TASK DEFINITION:
-                    # - For each problem identifier provided in the input list, identify the upper boundary of the entire problem, including the problem statement.
-                    # - Return the y-coordinate value (in pixels from the top of the image) for this upper boundary.
-                    # - The y-coordinate represents the vertical position where the identifier to a problem begins.
-
-                    # PROBLEM NUMBERING CONVENTIONS:
-                    # - Problem identifiers are provided as strings in the solution_numbers list.
-                    # - These identifiers represent main problems (e.g., "1", "2.", "3)", "4.5")
-
-                    # OUTPUT FORMAT:
-                    # - Use -1 for any problem whose boundary cannot be confidently determined, or if the problem is not present in the image.
-
-                    # HANDLING EDGE CASES:
-                    # - If problem boundaries are unclear or solutions overlap, use visual cues such as whitespace, horizontal lines, or changes in formatting to determine boundaries.
-                    # - If multiple possible boundaries exist, choose the most visually distinct one.
-
-                    # The problem identifiers to detect are: {solution_numbers}
-                    # """
-                    content=user_prompt
-                )
-            ]
-        ),
-        LLMUserMessage(
-            parts=[
-                LLMMessagePart(
-                    content_type=LLMMessageContentType.JPEG,
-                    content=base64.b64encode(image_bytes).decode()
-                ),
-            ]
-        ),
-        ],
-        # model="gemini-2.0-flash-001",
-        # router=get_router(models=(LLMModelName.GEMINI_20_FLASH,)),
-        router=get_router(models=(LLMModelName.GEMINI_25_FLASH,)),
-        # router=get_router(models=("gemini-2.0-flash-001")),
-        response_model=NumberedSolutionUpperBounds
+async def get_numbered_solution_upper_bounds(image_bytes: bytes|ImagePayload, system_prompt:str, user_prompt: str, solution_numbers: List[str], example_image_bytes: bytes|None=None, cache: ResponseCache|None=None):
+
+    # Previous system prompt
+    # f"""
+    # Return the y-axis positions at the top of each problem or subproblem solutions. Never return masks.
+    # """,
+
+    # Previous user prompts
+    # content=f"""
+    # Detect the upper bound of solutions to the problems or subproblems in the image for the provided problem numbers.
+    # Include the problem statement and/or prompt when calculating the upper bounds.
+    # If a problem has multiple parts (e.g., 1a, 1b, 1c), treat each part as a separate problem, and return the upper bound for each part.
+    # Problems are typically denoted by a number, sometimes with a period or parenthesis (e.g., "1", "2.", "3)")
+    # Subproblems are typically denoted by a letter, sometimes with a period or parenthesis (e.g., "a", "b.", "c)")
+    # The upper bounds are the y-axis positions at the top of each problem or subproblem solutions.
+    # If you cannot detect the upper bound for a problem or subproblem, return -1.
+    # The problem numbers are {[f"{k1}" for k1 in solution_numbers]}.
+    # Return a dictionary with the problem numbers as keys and the upper bounds as values.
+    # The dictionary should be in the format {{ "1": 100, "2a": 200, "2b": 300, "2c": -1, "3": 400 }}.
+    # """,
+    # content=f"""
+    # Detect the upper boundary y-coordinate of solutions to problems in the provided image.
+
+    # TASK DEFINITION:
+    # - For each problem identifier provided in the input list, identify where the solution area begins (upper boundary).
+    # - Return the y-coordinate value (in pixels from the top of the image) for this upper boundary.
+    # - The y-coordinate represents the vertical position where the solution to the current problem begins.
+
+    # PROBLEM NUMBERING CONVENTIONS:
+    # - Problem identifiers are provided as strings in the solution_numbers list.
+    # - These identifiers represent main problems (e.g., "1", "2.", "3)", "4.5")
+
+    # OUTPUT FORMAT:
+    # - Use -1 for any problem whose boundary cannot be confidently determined, or if the problem is not present in the image.
+
+    # HANDLING EDGE CASES:
+    # - If problem boundaries are unclear or solutions overlap, use visual cues such as whitespace, horizontal lines, or changes in formatting to determine boundaries.
+    # - If multiple possible boundaries exist, choose the most visually distinct one.
+
+    # The problem identifiers to detect are: {solution_numbers}
+    # """
+    # content=f"""
+    # Detect the y-coordinate of the upper boundary problems in the provided image, including the problem statement.
+
+    # TASK DEFINITION:
+    # - For each problem identifier provided in the input list, identify the upper boundary of the entire problem, including the problem statement.
+    # - Return the y-coordinate value (in pixels from the top of the image) for this upper boundary.
+    # - The y-coordinate represents the vertical position where the identifier to a problem begins.
+
+    # PROBLEM NUMBERING CONVENTIONS:
+    # - Problem identifiers are provided as strings in the solution_numbers list.
+    # - These identifiers represent main problems (e.g., "1", "2.", "3)", "4.5")
+
+    # OUTPUT FORMAT:
+    # - Use -1 for any problem whose boundary cannot be confidently determined, or if the problem is not present in the image.
+
+    # HANDLING EDGE CASES:
+    # - If problem boundaries are unclear or solutions overlap, use visual cues such as whitespace, horizontal lines, or changes in formatting to determine boundaries.
+    # - If multiple possible boundaries exist, choose the most visually distinct one.
+
+    # The problem identifiers to detect are: {solution_numbers}
+    # """
+
+    solution_upper_bounds = await _llm_structured_image(
+        image_bytes=image_bytes,
+        system_prompt=system_prompt,
+        user_prompt=user_prompt,
+        model=NUMBERED_SOLUTION_UPPER_BOUNDS_MODEL,
+        response_model=NumberedSolutionUpperBounds,
+        cache=cache,
     )
     
     return solution_upper_bounds
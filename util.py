@@ -2,16 +2,119 @@
 
 # Imports
 
-from hmac import new
+# pdf2image and IPython are imported where they are used, so importing util stays fast and works on headless hosts
+
 import io
+import mmap
 import os
-from pickletools import optimize
-from turtle import width
-from pdf2image import convert_from_path
+import tempfile
+import time
 from PIL import Image, ImageColor, ImageDraw, ImageFilter, ImageFont
-from typing import List, Tuple
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from instrumentation import span
+
+
+########
+# Generator yielding the requested pages of a PDF one at a time
+def iter_pdf_pages(input_directory: str, input_file: str, pages: List[int]=[], dpi: int=150) -> Iterator[Tuple[int, Image.Image]]:
+    """
+    Rasterize the requested pages of a PDF, one page at a time.
+    Only the requested pages are rasterized. Each run of consecutive pages is rasterized by one poppler
+    call into a temporary directory, and pages are read back from disk one at a time, so a whole PDF costs
+    a couple of poppler processes while the generator holds only one page in memory.
+    Args:
+        input_directory (str): The directory where the PDF file is located.
+        input_file (str): The name of the PDF file (without extension).
+        pages (List[int], optional): Zero-based page numbers to rasterize, in order. If empty, all pages are included.
+        dpi (int, optional): The rasterization resolution.
+    Yields:
+        Tuple[int, Image]: The page number and the grayscale page image.
+    """
+    from pdf2image import convert_from_path, pdfinfo_from_path
+
+    pdf_path = os.path.join(f"{input_directory}/", f"{input_file}.pdf")
+    page_count = pdfinfo_from_path(pdf_path)["Pages"]
 
-from IPython.display import display
+    if len(pages) >= 1:
+        pages = [k1 for k1 in pages if k1 < page_count]
+    else:
+        pages = list(range(page_count))
+
+    # Runs of consecutive pages, e.g. [0, 1, 2, 5] becomes [[0, 1, 2], [5]]
+    runs: List[List[int]] = []
+    for page_number in pages:
+        if len(runs) > 0 and page_number == runs[-1][-1] + 1:
+            runs[-1].append(page_number)
+        else:
+            runs.append([page_number])
+
+    with tempfile.TemporaryDirectory() as output_folder:
+        for run in runs:
+            # pdf2image page numbers are one-based
+            with span("rasterize", dpi=dpi, pages=len(run)):
+                page_paths = convert_from_path(pdf_path, dpi=dpi, first_page=run[0] + 1, last_page=run[-1] + 1, output_folder=output_folder, paths_only=True, grayscale=True)
+            for page_number, page_path in zip(run, sorted(page_paths)):
+                with span("load", dpi=dpi) as stage:
+                    with Image.open(page_path) as page_image:
+                        image = page_image.convert("L")
+                    os.remove(page_path)
+                    stage.set(width=image.width, height=image.height)
+                yield page_number, image
+
+
+########
+# Write grayscale images stacked vertically into a single JPEG without building the canvas in memory
+def save_stacked_images(images: Iterable[Image.Image], output_path: str, quality: int=80) -> Tuple[int, int]:
+    """
+    Stack grayscale images vertically and save them as a single JPEG.
+    Pixel rows are spooled to a temporary file one image at a time, and the JPEG encoder
+    reads the combined image from a memory map of that file, so the full canvas is never
+    allocated in memory. Narrower images are padded with black on the right.
+    Args:
+        images (Iterable[Image]): The images to stack, top to bottom.
+        output_path (str): The path of the JPEG file to write.
+        quality (int, optional): The JPEG quality.
+    Returns:
+        Tuple[int, int]: The size of the combined image.
+    """
+    with tempfile.TemporaryFile() as spool:
+
+        # Spool each image's rows, keeping only the sizes
+        sizes = []
+        for image in images:
+            if image.mode != "L":
+                image = image.convert("L")
+            spool.write(image.tobytes())
+            sizes.append(image.size)
+
+        if len(sizes) == 0:
+            print(f"No pages to stack into {output_path}.")
+            return (0, 0)
+
+        max_width = max(width for width, height in sizes)
+        total_height = sum(height for width, height in sizes)
+
+        # Pad narrower images to the full width, one image at a time
+        if any(width != max_width for width, height in sizes):
+            padded_spool = tempfile.TemporaryFile()
+            spool.seek(0)
+            for width, height in sizes:
+                image = Image.frombytes("L", (width, height), spool.read(width * height))
+                padded_image = Image.new("L", (max_width, height))
+                padded_image.paste(image, (0, 0))
+                padded_spool.write(padded_image.tobytes())
+            spool.close()
+            spool = padded_spool
+
+        spool.flush()
+        with mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            combined_image = Image.frombuffer("L", (max_width, total_height), mapped, "raw", "L", 0, 1)
+            combined_image.save(output_path, "JPEG", quality=quality, optimize=True)
+            del combined_image
+        spool.close()
+
+    return (max_width, total_height)
 
 
 ########
@@ -19,6 +122,7 @@ from IPython.display import display
 def convert_pdf_to_pil_image(input_directory: str, input_file: str, pages: List[int]=[], stack: bool=False, output_directory: str="", dpi: int=150, quality: int=80, suffix: str="") -> Image.Image:
     """
     Convert a multi-page PDF into a single JPEG image.
+    Pages are rasterized and written one at a time (see iter_pdf_pages and save_stacked_images).
     Args:
         directory (str): The directory where the PDF file is located.
         input_file (str): The name of the PDF file (without extension).
@@ -30,40 +134,21 @@ def convert_pdf_to_pil_image(input_directory: str, input_file: str, pages: List[
     if not os.path.exists(os.path.join(f"{input_directory}/", f"{input_file}.pdf")):
         print(f"File {input_file}.pdf does not exist.")
 
-    # Convert PDF to list of PIL Image objects
-    images = convert_from_path(os.path.join(f"{input_directory}/", f"{input_file}.pdf"), dpi=dpi)
-    if len(pages) >= 1:
-        images = [images[k1] for k1 in pages if k1 < len(images)]
-    # images = [image.resize((int(image.width/2), int(image.height/2))) for image in images]
-    images = [image.convert("L") for image in images]
+    # Rasterize the requested pages lazily
+    images = iter_pdf_pages(input_directory, input_file, pages=pages, dpi=dpi)
 
-    if stack:
+    if output_directory == "" or os.path.exists(output_directory) == False:
+        output_directory = input_directory
 
-        # Calculate total height and max width
-        total_height = sum(image.height for image in images)
-        max_width = max(image.width for image in images)
-
-        # Create a new blank image with combined size
-        combined_image = Image.new("RGB", (max_width, total_height))
-        combined_image = combined_image.convert("L")
-        
-        # Paste all images vertically
-        y_offset = 0
-        for image in images:
-            combined_image.paste(image, (0, y_offset))
-            y_offset += image.height
+    if stack:
 
-        # Save as JPEG
-        if output_directory == "" or os.path.exists(output_directory) == False:
-            output_directory = input_directory
-        combined_image.save(os.path.join(f"{output_directory}/", f"{input_file}_combined{suffix}.jpg"), "JPEG", quality=quality, optimize=True)
+        # Save as JPEG, stacking pages vertically
+        save_stacked_images((image for page_number, image in images), os.path.join(f"{output_directory}/", f"{input_file}_combined{suffix}.jpg"), quality=quality)
 
     else:
 
-        # Save images and individual JPEGs
-        if output_directory == "" or os.path.exists(output_directory) == False:
-            output_directory = input_directory
-        for k1, image in enumerate(images):
+        # Save individual JPEGs
+        for k1, (page_number, image) in enumerate(images):
             image.save(os.path.join(f"{output_directory}/", f"{input_file}_{k1:02d}{suffix}.jpg"), "JPEG", quality=quality, optimize=True)
         
         
@@ -119,10 +204,12 @@ def resize_jpeg_image_height(directory: str, input_file: str, new_height: int=20
     new_width = int(image_width * (new_height / image_height))
     
     # Resize the image to half its original size
-    resized_image = image.resize((int(new_width), int(new_height)), Image.LANCZOS)
+    with span("resize", width=int(new_width), height=int(new_height)):
+        resized_image = image.resize((int(new_width), int(new_height)), Image.LANCZOS)
     
     # Save the resized image
-    resized_image.save(os.path.join(f"{directory}/", f"{input_file.split(suffix)[0]}_{new_height}.jpg"), "JPEG", quality=quality)
+    with span("encode", width=int(new_width), height=int(new_height)):
+        resized_image.save(os.path.join(f"{directory}/", f"{input_file.split(suffix)[0]}_{new_height}.jpg"), "JPEG", quality=quality)
     
     return resized_image
 
@@ -193,15 +280,101 @@ def sharpen_text(directory: str, input_file: str, radius: float=1.0, strength: f
     # radius: smaller radius works better for text
     # percent: amount of sharpening (higher = stronger effect)
     # threshold: minimum brightness change to apply sharpening
-    sharpened_image = image.filter(
-        ImageFilter.UnsharpMask(radius=radius, percent=strength, threshold=threshold)
-    )
+    with span("sharpen", width=image.width, height=image.height):
+        sharpened_image = image.filter(
+            ImageFilter.UnsharpMask(radius=radius, percent=strength, threshold=threshold)
+        )
 
-    sharpened_image.save(os.path.join(f"{directory}/", f"{input_file}_sharpened.jpg"), "JPEG", quality=100)
+    with span("encode", width=image.width, height=image.height):
+        sharpened_image.save(os.path.join(f"{directory}/", f"{input_file}_sharpened.jpg"), "JPEG", quality=100)
     
     return sharpened_image
 
 
+########
+# Derive every resized and sharpened variant of a page from one decoded image
+def derive_page_variants(image: Image.Image, output_directory: str, page_stem: str, heights: List[int]=[640, 768], original_suffix: str="_original", quality: int=100, resize_quality: int=96, sharpen: bool=True, radius: float=0.5, strength: float=150, threshold: float=2, outputs: List[str]|None=None) -> Dict[str, Dict[str, float]]:
+    """
+    Produce the original, resized and sharpened JPEGs of a page in one pass.
+    Replaces the resize_jpeg_image_height then sharpen_text chain for batch use: the page is
+    resized and sharpened from pixels already in memory instead of re-decoding intermediate
+    JPEGs, so there is no generation loss between variants. All variants are encoded in
+    memory and written at the end. File names match that chain, for example
+    E_231_HW_02_00_original.jpg, E_231_HW_02_00_768.jpg and E_231_HW_02_00_768_sharpened.jpg.
+    Args:
+        image (Image): The rasterized page.
+        output_directory (str): The directory to write the variants to.
+        page_stem (str): The file name prefix of the page, e.g. E_231_HW_02_00.
+        heights (List[int], optional): Heights of the resized variants.
+        original_suffix (str, optional): Suffix of the full resolution variant.
+        quality (int, optional): JPEG quality of the full resolution and sharpened variants.
+        resize_quality (int, optional): JPEG quality of the resized variants.
+        sharpen (bool, optional): Whether to also produce a sharpened copy of every variant.
+        radius, strength, threshold (float, optional): Unsharp mask parameters, see sharpen_text.
+        outputs (List[str], optional): Only produce these file names, e.g. the variants that are out of date. Defaults to all.
+    Returns:
+        Dict[str, Dict[str, float]]: Seconds spent per stage (resize, sharpen, encode, write), keyed by file name.
+    """
+    if image.mode != "L":
+        image = image.convert("L")
+    image_width, image_height = image.size
+
+    timings: Dict[str, Dict[str, float]] = {}
+    encoded: Dict[str, bytes] = {}
+
+    def wanted(file_name: str) -> bool:
+        return outputs is None or file_name in outputs
+
+    def encode(file_name: str, variant: Image.Image, variant_quality: int) -> None:
+        start = time.perf_counter()
+        encoded[file_name] = convert_pil_image_to_bytes(pil_image=variant, format="JPEG", quality=variant_quality)
+        timings[file_name]["encode"] = time.perf_counter() - start
+
+    def add_sharpened(stem: str, variant: Image.Image) -> None:
+        file_name = f"{stem}_sharpened.jpg"
+        if not sharpen or not wanted(file_name):
+            return
+        timings[file_name] = {}
+        start = time.perf_counter()
+        with span("sharpen", width=variant.width, height=variant.height):
+            sharpened_variant = variant.filter(ImageFilter.UnsharpMask(radius=radius, percent=strength, threshold=threshold))
+        timings[file_name]["sharpen"] = time.perf_counter() - start
+        encode(file_name, sharpened_variant, quality)
+
+    # Full resolution
+    original_stem = f"{page_stem}{original_suffix}"
+    if wanted(f"{original_stem}.jpg"):
+        timings[f"{original_stem}.jpg"] = {}
+        encode(f"{original_stem}.jpg", image, quality)
+    add_sharpened(original_stem, image)
+
+    # Resized variants, each from the full resolution pixels
+    for new_height in heights:
+        stem = f"{page_stem}_{new_height}"
+        file_name = f"{stem}.jpg"
+        if not wanted(file_name) and not (sharpen and wanted(f"{stem}_sharpened.jpg")):
+            continue
+        start = time.perf_counter()
+        new_width = int(image_width * (new_height / image_height))
+        with span("resize", width=int(new_width), height=int(new_height)):
+            resized_image = image.resize((int(new_width), int(new_height)), Image.LANCZOS)
+        resize_seconds = time.perf_counter() - start
+        if wanted(file_name):
+            timings[file_name] = {"resize": resize_seconds}
+            encode(file_name, resized_image, resize_quality)
+        add_sharpened(stem, resized_image)
+
+    # Write everything at the end
+    for file_name, image_bytes in encoded.items():
+        start = time.perf_counter()
+        with span("write", bytes_out=len(image_bytes)):
+            with open(os.path.join(output_directory, file_name), "wb") as f:
+                f.write(image_bytes)
+        timings[file_name]["write"] = time.perf_counter() - start
+
+    return timings
+
+
 ########
 # Function to convert a PIL Image to bytes
 def convert_pil_image_to_bytes(pil_image: Image.Image, format: str="JPEG", quality: int=80) -> bytes:
@@ -212,9 +385,12 @@ def convert_pil_image_to_bytes(pil_image: Image.Image, format: str="JPEG", quali
     Returns:
         bytes: The image in bytes format.
     """
-    with io.BytesIO() as output:
-        pil_image.save(output, format=format, quality=quality)
-        return output.getvalue()
+    with span("encode", width=pil_image.width, height=pil_image.height, format=format) as stage:
+        with io.BytesIO() as output:
+            pil_image.save(output, format=format, quality=quality)
+            image_bytes = output.getvalue()
+        stage.set(bytes_in=pil_image.width * pil_image.height * len(pil_image.getbands()), bytes_out=len(image_bytes))
+    return image_bytes
 
 
 ########
@@ -272,6 +448,7 @@ def plot_solution_upper_bounds(pil_image: Image.Image, solution_upper_bounds: Li
         draw.line((abs_x1, abs_y1, abs_x2, abs_y1), fill=color, width=4)
 
     # Display the image
+    from IPython.display import display
     display(im)
     
     # Return the image (either the modified original or the copy)
@@ -0,0 +1,223 @@
+# Long-running worker that keeps imports, routers, the response cache and detector models warm
+#
+# Usage:
+#   python worker.py --socket /tmp/bounding-box.sock --cache-directory .llm_cache --requests-per-minute 600
+#
+# Jobs are sent over a Unix socket as one JSON object per line, and each is answered with one JSON line:
+#   {"job": "assignment", "assignment_name": "E_231_HW_02", "input_directory": "jpg", "problem_numbers": ["1", "2"]}
+#   {"job": "assignment", ..., "pages": [0, 3]}     # only these page indices
+#   {"job": "assignment", ..., "detector": "yolo"}  # local label detector instead of the LLM
+#   {"job": "ingest", "manifest": {"E_231_HW_02": []}, "input_directory": "pdf", "output_directory": "jpg"}
+#   {"job": "stats"}
+#   {"job": "shutdown"}
+# Replies are {"ok": true, "result": ...} or {"ok": false, "error": "..."}. Jobs from several clients run concurrently
+# and share one response cache and, if set, one rate-limited scheduler. See send_job for a client.
+
+# Imports
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+from typing import Any, Dict, List
+
+import upper_bounds
+from assignment import IMAGE_HEIGHT, Assignment
+from ingest import ingest
+from page_manifest import PLAIN_VARIANT
+from response_cache import DEFAULT_CACHE_DIRECTORY, ResponseCache
+from scheduler import LLMScheduler
+
+
+DEFAULT_SOCKET = "/tmp/bounding-box.sock"
+
+
+class Worker():
+    """
+    Serves detection and ingestion jobs from one process, so each job skips interpreter startup,
+    imports, router construction and model loading.
+    """
+
+    def __init__(self, cache: ResponseCache|None=None, scheduler: LLMScheduler|None=None, max_concurrency: int=8):
+        self.cache = cache
+        self.scheduler = scheduler
+        self.max_concurrency = max_concurrency
+        self.detectors: Dict[str, Any] = {}
+        self.jobs = 0
+        self.failed_jobs = 0
+        self.started = time.time()
+        self.stopped = asyncio.Event()
+        if scheduler is not None:
+            upper_bounds.set_scheduler(scheduler)
+
+
+    def detector(self, name: str) -> Any:
+        # Detectors, and the models they load, are kept for the life of the worker
+        if name not in self.detectors:
+            from detectors import LLMDetector, YOLODetector
+            if name == "yolo":
+                # Assignments whose labels do not match their problems fail over to the shared LLM detector
+                self.detectors[name] = YOLODetector(fallback=self.detector("llm"))
+            elif name == "llm":
+                self.detectors[name] = LLMDetector(max_concurrency=self.max_concurrency, cache=self.cache)
+            else:
+                raise ValueError(f"Unknown detector {name}")
+        return self.detectors[name]
+
+
+    async def run_assignment(self, job: Dict[str, Any]) -> Dict[str, Any]:
+
+        assignment = Assignment(
+            assignment_name=job["assignment_name"],
+            input_directory=job["input_directory"],
+            problem_numbers=job.get("problem_numbers", []),
+            image_height=str(job.get("image_height", IMAGE_HEIGHT)),
+            variant=job.get("variant", PLAIN_VARIANT),
+        )
+        page_indices = job.get("pages", list(range(len(assignment.pages))))
+
+        if "detector" in job:
+            assignment.pages = [assignment.pages[k1] for k1 in page_indices]
+            page_indices = list(range(len(assignment.pages)))
+            await assignment.find_problem_positions_with_detector(self.detector(job["detector"]))
+        else:
+            skip_pages = [k1 for k1 in range(len(assignment.pages)) if k1 not in page_indices]
+            await assignment.find_problem_positions(max_concurrency=job.get("max_concurrency", self.max_concurrency), cache=self.cache, skip_pages=skip_pages)
+
+        pages = {}
+        for k1 in page_indices:
+            page = assignment.pages[k1]
+            pages[page.page_name] = {
+                "found_problems": page.found_problems,
+                "found_problems_normalized": page.found_problems_normalized,
+                "detection_mode": page.detection_mode,
+                "error": None if page.error is None else repr(page.error),
+            }
+            page.unload()
+        return {"problem_numbers": assignment.problem_numbers, "pages": pages}
+
+
+    async def run_ingest(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        # ingest runs its own process pool, so keep it off the event loop
+        report = await asyncio.to_thread(
+            ingest,
+            {assignment_name: [int(page) for page in pages] for assignment_name, pages in job["manifest"].items()},
+            input_directory=job.get("input_directory", "pdf"),
+            output_directory=job.get("output_directory", "jpg"),
+            heights=job.get("heights", [640, 768]),
+            workers=job.get("workers"),
+        )
+        return report.model_dump()
+
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "jobs": self.jobs,
+            "failed_jobs": self.failed_jobs,
+            "uptime_seconds": time.time() - self.started,
+            "detectors": sorted(self.detectors.keys()),
+            "cache": None if self.cache is None else self.cache.stats(),
+            "scheduler": None if self.scheduler is None else self.scheduler.stats(),
+        }
+
+
+    async def handle_job(self, job: Dict[str, Any]) -> Any:
+
+        kind = job.get("job")
+        if kind == "assignment":
+            return await self.run_assignment(job)
+        if kind == "ingest":
+            return await self.run_ingest(job)
+        if kind == "stats":
+            return self.stats()
+        if kind == "shutdown":
+            self.stopped.set()
+            return None
+        raise ValueError(f"Unknown job {kind}")
+
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+
+        try:
+            while not reader.at_eof():
+                line = await reader.readline()
+                if len(line.strip()) == 0:
+                    continue
+                self.jobs += 1
+                try:
+                    reply = {"ok": True, "result": await self.handle_job(json.loads(line))}
+                except Exception as error:
+                    self.failed_jobs += 1
+                    print(f"-- Job failed: {error!r}")
+                    reply = {"ok": False, "error": repr(error)}
+                writer.write((json.dumps(reply, default=str) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+    async def serve(self, socket_path: str=DEFAULT_SOCKET) -> None:
+        """
+        Serve jobs on a Unix socket until a shutdown job is received.
+        """
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+        print(f"Worker listening on {socket_path}")
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+########
+def send_job(job: Dict[str, Any], socket_path: str=DEFAULT_SOCKET, timeout: float|None=None) -> Any:
+    """
+    Send one job to a running worker and wait for the reply.
+    Args:
+        job (Dict): The job, e.g. {"job": "assignment", "assignment_name": "E_231_HW_02", "input_directory": "jpg"}.
+        socket_path (str, optional): The worker's socket.
+        timeout (float, optional): Seconds to wait for the reply.
+    Returns:
+        The job result.
+    Raises:
+        RuntimeError: If the job failed in the worker.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall((json.dumps(job) + "\n").encode())
+        with client.makefile("r") as replies:
+            reply = json.loads(replies.readline())
+    if not reply["ok"]:
+        raise RuntimeError(reply["error"])
+    return reply["result"]
+
+
+def main(argv: List[str]|None=None) -> int:
+
+    parser = argparse.ArgumentParser(description="Serve problem detection and ingestion jobs from a warm process.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    parser.add_argument("--cache-directory", default=DEFAULT_CACHE_DIRECTORY, help="Response cache directory, empty to disable the cache")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--requests-per-minute", type=float, default=None, help="Rate limit shared by all jobs, none if omitted")
+    parser.add_argument("--tokens-per-minute", type=float, default=None)
+    args = parser.parse_args(argv)
+
+    cache = ResponseCache(args.cache_directory) if args.cache_directory != "" else None
+    scheduler = None
+    if args.requests_per_minute is not None:
+        scheduler = LLMScheduler(requests_per_minute=args.requests_per_minute, tokens_per_minute=args.tokens_per_minute)
+
+    worker = Worker(cache=cache, scheduler=scheduler, max_concurrency=args.max_concurrency)
+    asyncio.run(worker.serve(args.socket))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())